@@ -0,0 +1,120 @@
+$(function(){
+    var grid = $('#score-grid');
+    if(grid.length == 0) return;
+
+    // the grid is loaded one tile at a time, as JSON
+    var tile = {
+        row: 0,
+        col: 0,
+        rows: grid.data('tile-rows'),
+        cols: grid.data('tile-cols'),
+        total_rows: 0,
+        total_cols: 0
+    };
+
+    function responseLink(response_id, name){
+        var href = grid.data('response-url').replace(/\/0(\/?)$/, "/" + response_id + "$1");
+        return $('<a></a>').attr('href', href).text(name);
+    }
+
+    function scoreText(score){
+        if(score == -1) return "-";
+        if(score == -2) return "(full)";
+        return score;
+    }
+
+    function render(data){
+        tile.total_rows = data.total_rows;
+        tile.total_cols = data.total_cols;
+        var table = grid.find('table').empty();
+        var head = $('<tr><td>&nbsp;</td></tr>');
+        $.each(data.mentors, function(j, mentor){
+            head.append($('<td></td>').append(responseLink(mentor[1], mentor[2])));
+        });
+        table.append($('<thead></thead>').append(head));
+
+        var body = $('<tbody></tbody>');
+        $.each(data.mentees, function(i, mentee){
+            var row = $('<tr></tr>').append($('<td></td>').append(responseLink(mentee[1], mentee[2])));
+            $.each(data.scores[i], function(j, score){
+                row.append($('<td class="number"></td>').attr({
+                    'data-mentee': mentee[0],
+                    'data-mentor': data.mentors[j][0]
+                }).text(scoreText(score)));
+            });
+            body.append(row);
+        });
+        table.append(body);
+
+        grid.find('.tile-position').text(
+            "Mentees " + Math.min(tile.row + 1, tile.total_rows) + "-" + Math.min(tile.row + tile.rows, tile.total_rows) + " of " + tile.total_rows + ", " +
+            "mentors " + Math.min(tile.col + 1, tile.total_cols) + "-" + Math.min(tile.col + tile.cols, tile.total_cols) + " of " + tile.total_cols
+        );
+    }
+
+    function load(){
+        // the browser revalidates the tile with its ETag, so an unchanged
+        // tile comes back as a 304, and is served from its cache
+        $.getJSON(grid.data('tile-url'), {row: tile.row, col: tile.col, rows: tile.rows, cols: tile.cols}, render);
+    }
+
+    grid.on('click', '.tile-nav', function(){
+        var rows = $(this).data('rows') || 0;
+        var cols = $(this).data('cols') || 0;
+        var row = tile.row + rows * tile.rows;
+        var col = tile.col + cols * tile.cols;
+        if(row < 0 || col < 0 || (rows && row >= tile.total_rows) || (cols && col >= tile.total_cols)) return;
+        tile.row = row;
+        tile.col = col;
+        load();
+    });
+
+    load();
+
+    // show how a score on the match grid breaks down when you hover over it.
+    // The breakdown for each pair is only fetched once
+    var url = grid.data('breakdown-url');
+    var labels = {
+        "field_of_study": "Field of study",
+        "gender": "Gender",
+        "availability": "Availability",
+        "skills": "Skills",
+        "interests": "Interests"
+    };
+    var popup = $('<div id="score-breakdown"></div>').hide().appendTo('body');
+    var loaded = {};
+    var current = null;
+
+    function show(cell, data){
+        if(current !== cell || !data.breakdown) return;
+        var lines = [];
+        for(var component in data.breakdown){
+            lines.push(labels[component] + ": " + data.breakdown[component]);
+        }
+        lines.push("Total: " + data.score);
+        var offset = $(cell).offset();
+        popup.html(lines.join("<br />")).css({
+            top: offset.top + $(cell).outerHeight(),
+            left: offset.left
+        }).show();
+    }
+
+    grid.on('mouseenter', 'td[data-mentee]', function(){
+        var cell = this;
+        var key = $(cell).data('mentee') + ":" + $(cell).data('mentor');
+        current = cell;
+        if(loaded[key]){
+            show(cell, loaded[key]);
+            return;
+        }
+        $.getJSON(url, {mentee_id: $(cell).data('mentee'), mentor_id: $(cell).data('mentor')}, function(data){
+            loaded[key] = data;
+            show(cell, data);
+        });
+    });
+
+    grid.on('mouseleave', 'td[data-mentee]', function(){
+        current = null;
+        popup.hide();
+    });
+});
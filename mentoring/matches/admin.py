@@ -0,0 +1,13 @@
+from django.contrib import admin
+from .models import ScoringProfile, ScoringRule
+
+class ScoringRuleInline(admin.TabularInline):
+    model = ScoringRule
+
+class ScoringProfileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'is_active')
+    inlines = [
+        ScoringRuleInline,
+    ]
+
+admin.site.register(ScoringProfile, ScoringProfileAdmin)
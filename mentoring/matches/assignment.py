@@ -0,0 +1,190 @@
+# Solvers that pair up the whole cohort at once (unlike Mentee.findSuitors,
+# which looks at one mentee at a time). They take a score matrix, like the one
+# from scoreMatrix() (one row per mentee, one column per mentor, negative
+# scores mean the pair can't be matched), and the number of mentees each
+# mentor can still take. They return a list with the column of the mentor
+# each mentee is assigned to (or None, if the mentee could not be assigned).
+import heapq
+from array import array
+from collections import defaultdict
+
+def optimalAssignment(scores, capacities):
+    """Assign mentees to mentors so that the total score is as high as
+    possible, without giving any mentor more mentees than his capacity. When
+    there is a tie, the assignment that matches the most mentees wins.
+
+    This is a min cost flow, solved by successive shortest paths: each mentee
+    is added one at a time, and Dijkstra's algorithm (over reduced costs, so
+    every edge is non-negative) finds the cheapest way to fit him in, which may
+    bump other mentees to different mentors. It runs in O(N * M * P), where P is
+    the number of mentors a search has to pass through (usually very few)"""
+    n = len(scores)
+    m = len(capacities)
+    # the last column is a pretend mentor with unlimited capacity, for the
+    # mentees who don't get a real one
+    unassigned = m
+    capacities = list(capacities) + [n]
+    # scale the scores so a higher score always wins, but matching a mentee
+    # (at any score) beats leaving him out
+    scale = n + 1
+    INFINITY = float("inf")
+
+    # row_potential and column_potential keep every reduced cost
+    # (cost + row_potential - column_potential) non-negative
+    row_potential = [0] * n
+    column_potential = [0] * (m + 1)
+    assignment = [None] * n
+    members = [[] for column in capacities]
+    # mentors who have no room can be ignored completely
+    full = [capacity <= 0 for capacity in capacities]
+    # 1 if the mentor has no room left, 0 if he does
+    busy = [0] * (m + 1)
+
+    for source in range(n):
+        row_scores = scores[source]
+        row_potential[source] = max([0] + [
+            column_potential[column] + s * scale + 1
+            for column, s in enumerate(row_scores) if s >= 0 and not full[column]
+        ])
+
+        # distance to each column. The columns we have already been through
+        # are "used", and get an infinite key so min() skips over them. The
+        # key breaks ties between equally distant columns in favor of mentors
+        # who have room, since reaching one of those ends the search
+        distance = [INFINITY] * (m + 1)
+        key = [INFINITY] * (m + 1)
+        used = list(full) + [False]
+        way = [None] * (m + 1)
+        for column, s in enumerate(row_scores):
+            if s >= 0 and not used[column]:
+                distance[column] = row_potential[source] - (s * scale + 1) - column_potential[column]
+                key[column] = 2 * distance[column] + busy[column]
+                way[column] = source
+        distance[unassigned] = row_potential[source] - column_potential[unassigned]
+        key[unassigned] = 2 * distance[unassigned]
+        way[unassigned] = source
+        reached_rows = [(source, 0)]
+        popped = []
+
+        while True:
+            # find the closest column we haven't been through yet
+            closest = key.index(min(key))
+            best = distance[closest]
+            used[closest] = True
+            key[closest] = INFINITY
+            popped.append(closest)
+
+            # this mentor has room, so we found the cheapest path
+            if not busy[closest]:
+                break
+
+            # otherwise, try bumping each of this mentor's mentees elsewhere
+            for row in members[closest]:
+                reached_rows.append((row, best))
+                offset = best + row_potential[row]
+                for column, s in enumerate(scores[row]):
+                    if s >= 0 and not used[column]:
+                        d = offset - (s * scale + 1) - column_potential[column]
+                        if d < distance[column]:
+                            distance[column] = d
+                            key[column] = 2 * d + busy[column]
+                            way[column] = row
+                d = offset - column_potential[unassigned]
+                if d < distance[unassigned]:
+                    distance[unassigned] = d
+                    key[unassigned] = 2 * d
+                    way[unassigned] = row
+
+        # update the potentials so the reduced costs stay non-negative
+        for column in popped:
+            column_potential[column] += distance[column] - best
+        for row, d in reached_rows:
+            row_potential[row] += d - best
+
+        # walk back along the path, moving each mentee to his new mentor
+        column = closest
+        while True:
+            row = way[column]
+            previous = assignment[row]
+            if previous is not None:
+                members[previous].remove(row)
+                busy[previous] = 0
+            assignment[row] = column
+            members[column].append(row)
+            busy[column] = int(len(members[column]) >= capacities[column])
+            if row == source:
+                break
+            column = previous
+
+    return [None if column == unassigned else column for column in assignment]
+
+def _byScore(scores):
+    """Return an array of the indexes of the non-negative scores, ordered by
+    score (highest first), and then by index. The scores are small integers,
+    so this is a counting sort, and takes linear time"""
+    buckets = defaultdict(list)
+    for index, s in enumerate(scores):
+        if s >= 0:
+            buckets[s].append(index)
+    ordered = array("i")
+    for s in sorted(buckets, reverse=True):
+        ordered.extend(buckets[s])
+    return ordered
+
+def stableAssignment(scores, capacities):
+    """Assign mentees to mentors so the assignment is stable: there is no
+    mentee and mentor who would both rather be with each other than with who
+    they were assigned. Each side prefers the people it scored highest with
+    (ties go to whoever comes first), and a mentor can hold as many mentees as
+    his capacity.
+
+    This is the deferred acceptance algorithm (Gale-Shapley, the
+    hospitals/residents version): mentees propose to mentors in order of
+    preference, and a full mentor bumps the mentee he likes least when a better
+    one comes along. Every mentee proposes to each mentor at most once, so it
+    runs in O(N * M)"""
+    n = len(scores)
+    m = len(capacities)
+
+    # each mentee's mentors, most preferred first
+    preferences = [
+        array("i", [column for column in _byScore(row) if capacities[column] > 0])
+        for row in scores
+    ]
+    # rank[column][row] is where the mentee falls on the mentor's list (lower
+    # is better)
+    rank = []
+    for column in range(m):
+        ranks = array("i", [n] * n)
+        for position, row in enumerate(_byScore([scores[row][column] for row in range(n)])):
+            ranks[row] = position
+        rank.append(ranks)
+
+    # the mentees each mentor is holding on to, as a heap with the least
+    # preferred mentee on top
+    held = [[] for column in range(m)]
+    # the next position on each mentee's preference list to propose to
+    next_proposal = array("i", [0] * n)
+    assignment = [None] * n
+    free = list(range(n))
+
+    while free:
+        row = free.pop()
+        preference = preferences[row]
+        while next_proposal[row] < len(preference):
+            column = preference[next_proposal[row]]
+            next_proposal[row] += 1
+            heap = held[column]
+            if len(heap) < capacities[column]:
+                heapq.heappush(heap, (-rank[column][row], row))
+                assignment[row] = column
+                break
+            # the mentor is full, so he keeps whoever he likes better
+            if -heap[0][0] > rank[column][row]:
+                worst_rank, bumped = heapq.heapreplace(heap, (-rank[column][row], row))
+                assignment[row] = column
+                assignment[bumped] = None
+                free.append(bumped)
+                break
+
+    return assignment
@@ -0,0 +1,70 @@
+import time
+from datetime import timedelta
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from mentoring.matches.models import archiveResponses
+
+# the tables archiving frees up space in
+TABLES = ("response", "response_question", "response_features")
+
+def tableSizes():
+    """Return a dict of table name -> (bytes used, bytes free) for each of
+    TABLES, or an empty dict if the database can't tell us (it isn't MySQL)"""
+    if connection.vendor != "mysql":
+        return {}
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT
+            table_name,
+            data_length + index_length,
+            data_free
+        FROM
+            information_schema.tables
+        WHERE
+            table_schema = DATABASE() AND
+            table_name IN (%s)
+    """ % (",".join(["%s"] * len(TABLES))), TABLES)
+    return dict((name, (used, free)) for name, used, free in cursor.fetchall())
+
+class Command(BaseCommand):
+    help = (
+        "Move responses that were replaced by a newer one (and their answers) "
+        "to the response_archive and response_question_archive tables, a "
+        "batch at a time, so it can run while the site is up. Responses a "
+        "mentor or mentee still points at are left alone."
+    )
+    option_list = BaseCommand.option_list + (
+        make_option("--days", type="int", default=90, help="Only archive responses older than this many days"),
+        make_option("--batch-size", type="int", default=500, help="How many responses to move in each transaction"),
+        make_option("--pause", type="float", default=0.5, help="Seconds to wait between batches, to go easy on the database"),
+        make_option("--optimize", action="store_true", default=False, help="Run OPTIMIZE TABLE afterwards, to give the space back to the filesystem (MySQL only)"),
+    )
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options["days"])
+        sizes = tableSizes()
+
+        responses = response_questions = 0
+        while True:
+            moved_responses, moved_response_questions = archiveResponses(before, batch_size=options["batch_size"])
+            responses += moved_responses
+            response_questions += moved_response_questions
+            if moved_responses < options["batch_size"]:
+                break
+            time.sleep(options["pause"])
+
+        self.stdout.write("Archived %d responses and %d response_question rows" % (responses, response_questions))
+
+        if options["optimize"] and connection.vendor == "mysql" and responses:
+            cursor = connection.cursor()
+            for table in TABLES:
+                cursor.execute("OPTIMIZE TABLE " + table)
+                cursor.fetchall()
+
+        # InnoDB keeps the space the rows used for new rows (it shows up as
+        # free), so the tables only get smaller when they are optimized
+        for table, (used, free) in sorted(tableSizes().items()):
+            if table in sizes:
+                self.stdout.write("%s: %d bytes smaller, %d bytes free for new rows" % (table, sizes[table][0] - used, free))
@@ -0,0 +1,135 @@
+import json
+import resource
+import time
+from datetime import datetime
+from itertools import cycle
+from optparse import make_option
+from ordereddict import OrderedDict
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from mentoring.matches import views
+from mentoring.matches.models import Mentor, Mentee, Match, MatchScore, ResponseFeatures
+from mentoring.matches.models import buildResponseQuestionLookupTable, suitorIndex, proposeAssignment
+from .generatecohort import USERNAME_PREFIX
+
+def peakMemory():
+    """The most memory this process has used so far (in KB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Command(BaseCommand):
+    help = (
+        "Time each stage of matching against whatever is in the database "
+        "(see generatecohort), and write the wall time, number of queries "
+        "and peak memory of each stage as JSON."
+    )
+    option_list = BaseCommand.option_list + (
+        make_option("--output", help="Write the results to this file, instead of stdout"),
+        make_option("--stages", help="A comma separated list of the stages to run (all of them by default)"),
+        make_option("--pairs", type="int", default=1000, help="How many pairs the lookup_table stage builds a lookup table for"),
+        make_option("--label", default="", help="A note to include with the results (like the git revision)"),
+    )
+
+    def handle(self, *args, **options):
+        self.pairs = options["pairs"]
+        stages = OrderedDict([
+            ("lookup_table", (None, self.lookupTable)),
+            ("score_grid_cold", (self.clearScores, self.scoreGrid)),
+            ("score_grid_warm", (None, self.scoreGrid)),
+            ("find_suitors", (None, self.findSuitors)),
+            ("by_mentor", (None, self.byMentor)),
+            ("propose_assignment", (None, self.proposeAssignment)),
+            ("match_page", (None, self.matchPage)),
+        ])
+        names = stages.keys()
+        if options["stages"]:
+            names = [name.strip() for name in options["stages"].split(",")]
+            for name in names:
+                if name not in stages:
+                    raise CommandError("%s is not a stage. Pick from %s" % (name, ", ".join(stages)))
+
+        results = OrderedDict([
+            ("label", options["label"]),
+            ("started_on", datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+            ("database", connection.vendor),
+            ("mentors", Mentor.objects.count()),
+            ("mentees", Mentee.objects.filter(is_deleted=False).count()),
+            ("stages", []),
+        ])
+        for name in names:
+            setup, run = stages[name]
+            if setup is not None:
+                setup()
+            results["stages"].append(self.measure(name, run))
+
+        output = json.dumps(results, indent=4)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    def measure(self, name, run):
+        before = peakMemory()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.time()
+            run()
+            seconds = time.time() - start
+        after = peakMemory()
+        return OrderedDict([
+            ("name", name),
+            ("seconds", round(seconds, 4)),
+            ("queries", len(queries)),
+            ("peak_memory_kb", after),
+            ("peak_memory_growth_kb", after - before),
+        ])
+
+    def lookupTable(self):
+        buildResponseQuestionLookupTable.cache.clear()
+        mentees = list(Mentee.objects.filter(is_deleted=False).select_related("response")[:self.pairs])
+        mentors = list(Mentor.objects.all().select_related("response")[:self.pairs])
+        if mentees and mentors:
+            for i, (mentee, mentor) in zip(range(self.pairs), zip(cycle(mentees), cycle(mentors))):
+                buildResponseQuestionLookupTable(mentee.response, mentor.response)
+
+    def clearScores(self):
+        MatchScore.objects.all().delete()
+
+    def scoreGrid(self):
+        # every tile of the grid, the way the match page loads them
+        mentees = list(Mentee.objects.filter(is_deleted=False).order_by("pk"))
+        mentors = list(Mentor.objects.all().order_by("pk"))
+        for row in range(0, len(mentees), views.TILE_ROWS):
+            for col in range(0, len(mentors), views.TILE_COLUMNS):
+                MatchScore.objects.tile(mentees[row:row+views.TILE_ROWS], mentors[col:col+views.TILE_COLUMNS])
+
+    def findSuitors(self):
+        mentees = list(Mentee.objects.unmatched())
+        mentors = list(Mentor.objects.withMenteeCount())
+        ResponseFeatures.objects.attach(mentees + mentors)
+        index = suitorIndex(mentors)
+        for mentee in mentees:
+            mentee.findSuitors(mentors, index=index)
+
+    def byMentor(self):
+        Match.objects.byMentor(married=False)
+        Match.objects.byMentor(married=True)
+
+    def proposeAssignment(self):
+        proposeAssignment(list(Mentee.objects.unmatched()), list(Mentor.objects.withMenteeCount()))
+
+    def matchPage(self):
+        user, created = User.objects.get_or_create(username=USERNAME_PREFIX + "staff", defaults={"is_staff": True})
+        request = RequestFactory().get("/manage/match")
+        request.user = user
+        request.session = {}
+        # the match page adds a message when email notifications are on
+        request._messages = FakeMessages()
+        views.match(request)
+
+class FakeMessages(list):
+    """Stands in for the messages framework, since there is no real request"""
+    def add(self, level, message, extra_tags=""):
+        self.append(message)
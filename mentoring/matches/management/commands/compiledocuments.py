@@ -0,0 +1,29 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from mentoring.surveys.models import Response, ResponseDocument
+
+class Command(BaseCommand):
+    help = (
+        "Compile the answer sheet document of every response that doesn't "
+        "have one yet (responses saved before documents existed). Use --all "
+        "to rebuild them all, after the questions have been edited."
+    )
+    option_list = BaseCommand.option_list + (
+        make_option("--all", action="store_true", default=False, help="Rebuild every document, not just the missing ones"),
+        make_option("--batch-size", type="int", default=500, help="How many documents to compile in each transaction"),
+    )
+
+    def handle(self, *args, **options):
+        responses = Response.objects.order_by("pk")
+        if not options["all"]:
+            responses = responses.exclude(pk__in=ResponseDocument.objects.values("pk"))
+        response_ids = list(responses.values_list("pk", flat=True))
+
+        batch_size = options["batch_size"]
+        for start in range(0, len(response_ids), batch_size):
+            with transaction.atomic():
+                for response in Response.objects.filter(pk__in=response_ids[start:start+batch_size]):
+                    ResponseDocument.objects.compile(response)
+
+        self.stdout.write("Compiled %d documents" % (len(response_ids),))
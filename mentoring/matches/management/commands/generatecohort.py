@@ -0,0 +1,174 @@
+import random
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import transaction
+from mentoring.surveys.models import Survey, Question, Choice, Response, ResponseQuestion
+from mentoring.surveys.fieldsofstudy import addChoices, FIELD_OF_STUDY_QUESTIONS
+from mentoring.matches.models import Mentor, Mentee, Match, MatchScore, ResponseFeatures, buildResponseQuestionLookupTable
+from mentoring.matches.models import MENTOR_SURVEY_PK, MENTEE_SURVEY_PK
+from mentoring.matches.scoring import MENTOR_QUESTIONS, MENTEE_QUESTIONS
+
+# every synthetic user's username starts with this, so they can be found (and
+# removed) later
+USERNAME_PREFIX = "synthetic-"
+# how many people are created in each transaction
+BATCH_SIZE = 500
+
+class AnswerGenerator(object):
+    """Makes up plausible answers to every question on a survey, using the
+    survey's real questions and choices"""
+    def __init__(self, survey, roles, rng):
+        self.rng = rng
+        self.roles = dict((q_id, role) for role, q_id in roles.items())
+        self.questions = list(Question.objects.filter(survey=survey).exclude(type=Question.HEADING))
+        for question in self.questions:
+            if question.pk in FIELD_OF_STUDY_QUESTIONS and not Choice.objects.filter(question=question).exists():
+                addChoices(question)
+
+        self.choices = dict((question.pk, []) for question in self.questions)
+        for choice in Choice.objects.filter(question__survey=survey).order_by("rank"):
+            self.choices[choice.question_id].append(choice)
+
+        # the fields of study, grouped by college, and the departments in each
+        self.groups = {}
+        self.leaves = {}
+        schema = Survey.objects.schema(survey.pk)
+        for compiled in schema.questions:
+            tree = compiled.tree
+            if tree is None:
+                continue
+            by_heading = {}
+            groups = []
+            for leaf in tree.leaves:
+                heading = tree.groups.get(leaf.pk)
+                if heading is not None:
+                    if heading.pk not in by_heading:
+                        by_heading[heading.pk] = []
+                        groups.append(by_heading[heading.pk])
+                    by_heading[heading.pk].append(leaf)
+            # the fields of study that aren't under a heading are a group of their own
+            groups.extend([leaf] for leaf in tree.leaves if leaf.pk not in tree.groups)
+            self.groups[compiled.question.pk] = groups
+            self.leaves[compiled.question.pk] = list(tree.leaves)
+
+    def answers(self):
+        """Return a list of (question, choice, value) tuples for one person"""
+        rng = self.rng
+        # people tend to prefer their own field of study, or one close to it
+        home = {}
+        for q_id, groups in self.groups.items():
+            if groups:
+                home[q_id] = rng.choice(groups)
+
+        answers = []
+        for question in self.questions:
+            role = self.roles.get(question.pk)
+            choices = self.choices[question.pk]
+            if not question.required and rng.random() < 0.1:
+                continue
+
+            if question.type == Question.LIKERT:
+                answers.append((question, None, str(rng.choice([0, 1, 2, 2, 3, 3, 3, 4, 4]))))
+            elif question.type in (Question.TEXTBOX, Question.TEXTAREA):
+                if role == "capacity":
+                    answers.append((question, None, str(rng.choice([1, 1, 2, 2, 3]))))
+                else:
+                    answers.append((question, None, "Synthetic answer"))
+            elif not choices:
+                continue
+            elif question.type in (Question.RADIO, Question.SELECT):
+                choice = rng.choice(choices)
+                if role == "has_mentor_in_mind":
+                    # most mentees don't have someone in mind
+                    wanted = "yes" if rng.random() < 0.1 else "no"
+                    choice = ([c for c in choices if c.value.strip().lower() == wanted] or [choice])[0]
+                answers.append((question, choice, "Synthetic answer" if choice.has_textbox else choice.value))
+            elif question.type == Question.SELECT_MULTIPLE:
+                leaves = self.leaves[question.pk]
+                if not leaves:
+                    continue
+                group = home.get(question.pk, leaves)
+                if role == "field_of_study_preference" and rng.random() < 0.5:
+                    picked = rng.sample(leaves, min(len(leaves), rng.randint(1, 3)))
+                elif role == "field_of_study_preference":
+                    picked = rng.sample(group, min(len(group), rng.randint(1, 3)))
+                else:
+                    picked = [rng.choice(group)]
+                    if rng.random() < 0.3:
+                        picked.append(rng.choice(leaves))
+                for choice in set(picked):
+                    answers.append((question, choice, choice.value))
+            else:
+                for choice in rng.sample(choices, rng.randint(1, min(3, len(choices)))):
+                    answers.append((question, choice, "Synthetic answer" if choice.has_textbox else choice.value))
+
+        return answers
+
+def clearCohort():
+    """Remove every synthetic person (and everything about them)"""
+    users = User.objects.filter(username__startswith=USERNAME_PREFIX)
+    MatchScore.objects.filter(mentor__user__in=users).delete()
+    MatchScore.objects.filter(mentee__user__in=users).delete()
+    Match.objects.filter(mentor__user__in=users).delete()
+    Match.objects.filter(mentee__user__in=users).delete()
+    Mentor.objects.filter(user__in=users).delete()
+    Mentee.objects.filter(user__in=users).delete()
+    ResponseFeatures.objects.filter(response__user__in=users).delete()
+    ResponseQuestion.objects.filter(response__user__in=users).delete()
+    Response.objects.filter(user__in=users).delete()
+    users.delete()
+    buildResponseQuestionLookupTable.cache.clear()
+
+def generatePeople(model, survey, generator, count, label):
+    """Create count people (Mentors or Mentees) who have answered the survey"""
+    prefix = "%s%s-" % (USERNAME_PREFIX, label)
+    start = User.objects.filter(username__startswith=prefix).count()
+    for batch_start in range(start, start + count, BATCH_SIZE):
+        numbers = range(batch_start, min(start + count, batch_start + BATCH_SIZE))
+        with transaction.atomic():
+            User.objects.bulk_create([
+                User(username="%s%06d" % (prefix, i), first_name="Synthetic", last_name="%s %d" % (label.capitalize(), i))
+                for i in numbers
+            ])
+            users = list(User.objects.filter(username__in=["%s%06d" % (prefix, i) for i in numbers]))
+            # bulk_create doesn't set the primary keys, so read them back
+            Response.objects.bulk_create([Response(user=user, survey=survey) for user in users])
+            responses = dict(Response.objects.filter(user__in=users, survey=survey).values_list("user_id", "pk"))
+
+            ResponseQuestion.objects.bulk_create([
+                ResponseQuestion(response_id=responses[user.pk], question=question, choice=choice, value=value)
+                for user in users
+                for question, choice, value in generator.answers()
+            ], batch_size=1000)
+            model.objects.bulk_create([model(user=user, response_id=responses[user.pk]) for user in users])
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with synthetic mentors and mentees, who answer the "
+        "real mentor and mentee surveys (the surveys have to be in the "
+        "database already). Their features are compiled, and their scores "
+        "computed, the first time they are scored."
+    )
+    option_list = BaseCommand.option_list + (
+        make_option("--size", type="int", default=100, help="How many mentors, and how many mentees, to create (like 100, 1000 or 10000)"),
+        make_option("--seed", type="int", default=0, help="Seed for the random answers, so a cohort can be recreated"),
+        make_option("--clear", action="store_true", default=False, help="Remove the synthetic people from earlier runs first"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            mentor_survey = Survey.objects.get(pk=MENTOR_SURVEY_PK)
+            mentee_survey = Survey.objects.get(pk=MENTEE_SURVEY_PK)
+        except Survey.DoesNotExist:
+            raise CommandError("The mentor and mentee surveys need to be in the database first")
+
+        if options["clear"]:
+            clearCohort()
+
+        rng = random.Random(options["seed"])
+        size = options["size"]
+        generatePeople(Mentor, mentor_survey, AnswerGenerator(mentor_survey, MENTOR_QUESTIONS, rng), size, "mentor")
+        generatePeople(Mentee, mentee_survey, AnswerGenerator(mentee_survey, MENTEE_QUESTIONS, rng), size, "mentee")
+        buildResponseQuestionLookupTable.cache.clear()
+        self.stdout.write("Created %d mentors and %d mentees" % (size, size))
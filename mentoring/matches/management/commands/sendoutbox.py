@@ -0,0 +1,27 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from mentoring.matches.models import Outbox
+
+class Command(BaseCommand):
+    help = (
+        "Send the queued emails in the outbox, in batches over one connection "
+        "to the mail server. Run it from cron, or with --loop to keep it "
+        "running."
+    )
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", type="int", default=100, help="How many emails to send over each connection"),
+        make_option("--loop", action="store_true", default=False, help="Keep checking for new emails, instead of exiting when the outbox is empty"),
+        make_option("--interval", type="int", default=10, help="Seconds to wait before checking the outbox again (with --loop)"),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            # keep going while there are full batches to send (a batch with
+            # failures in it still counts, since the failures are retried later)
+            while Outbox.objects.deliver(batch_size=options["batch_size"]) == options["batch_size"]:
+                pass
+
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
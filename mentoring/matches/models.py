@@ -1,14 +1,30 @@
+import threading
 from collections import defaultdict, namedtuple
-from datetime import datetime
-from django.db import models
-from django.core.mail import send_mail
+from datetime import timedelta
+from ordereddict import OrderedDict
+from django.conf import settings as SETTINGS
+from django.core.exceptions import ValidationError
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.core.mail import EmailMessage, get_connection
 from django.contrib.auth.models import User
 from django.template import Context, Template
+from django.utils import timezone
 from mentoring.surveys.models import ResponseQuestion, Question, Response
+from mentoring.surveys.signals import response_changed
+from mentoring.utils import VersionToken
+from .scoring import Features, FeatureEncoder, Vocabulary, SuitorIndex, Plan, Rule, scoreMatrix, parallelScoreMatrix, checkRule
+from .scoring import DEFAULT_RULES, ROLE_TYPES, OVERLAP, EQUAL, AT_LEAST, LIKERT, COMPONENTS, SCORED_QUESTIONS, unpackBreakdown
+from .assignment import optimalAssignment
 
 MENTOR_SURVEY_PK = 1
 MENTEE_SURVEY_PK = 2
 
+# changes every time the Settings are saved (see VersionToken). For the change
+# to reach every process, CACHES has to be a cache they share
+SETTINGS_VERSION = VersionToken("mentoring.settings.version")
+
 class SettingsManager(models.Manager):
     def default(self):
         try:
@@ -18,6 +34,22 @@ class SettingsManager(models.Manager):
             instance.save()
         return instance
 
+    def cached(self):
+        """Return the Settings like default() does, but from a cache in this
+        process, along with the compiled mentor_template and mentee_template.
+        It is reloaded when the Settings are saved (see settingsChanged()).
+        Don't modify what it returns; use default() for that"""
+        version = SETTINGS_VERSION.get()
+        cached = SettingsManager.cache
+        if "settings" not in cached or cached["version"] != version:
+            instance = self.default()
+            instance.mentor_template = Template(instance.mentor_body)
+            instance.mentee_template = Template(instance.mentee_body)
+            SettingsManager.cache = {"version": version, "settings": instance}
+        return SettingsManager.cache["settings"]
+
+SettingsManager.cache = {}
+
 class Settings(models.Model):
     # email settings
     send_email = models.BooleanField(default=False, blank=True, help_text="Send an email notification to the mentor and mentee when they are matched")
@@ -35,6 +67,13 @@ class Settings(models.Model):
 
     objects = SettingsManager()
 
+@receiver(post_save, sender=Settings)
+@receiver(post_delete, sender=Settings)
+def settingsChanged(sender, **kwargs):
+    """Make every process reload its cached Settings"""
+    SettingsManager.cache = {}
+    SETTINGS_VERSION.bump()
+
 class MentorManager(models.Manager):
     def get_queryset(self):
         return super(MentorManager, self).get_queryset().filter(is_deleted=False)
@@ -98,6 +137,9 @@ class Mentor(models.Model):
     def delete(self):
         """Delete a mentor, and clean up loose ends"""
         user = self.user
+        # forget their answers
+        response_ids = Response.objects.filter(user=user, survey_id=MENTOR_SURVEY_PK).values_list('pk', flat=True)
+        buildResponseQuestionLookupTable.cache.invalidate(self.response_id, *response_ids)
         # remove their response questions
         ResponseQuestion.objects.filter(response__user=user, response__survey_id=MENTOR_SURVEY_PK).delete()
         # remove the response
@@ -154,6 +196,12 @@ class Mentee(models.Model):
     def delete(self):
         """Delete this mentee and all the related stuff"""
         user = self.user
+        # the mentors this mentee is matched with (read before anything is
+        # deleted, since deleting the response cascades to the matches)
+        mentor_ids = list(Match.objects.filter(mentee=self).values_list('mentor_id', flat=True))
+        # forget their answers
+        response_ids = Response.objects.filter(user=user, survey_id=MENTEE_SURVEY_PK).values_list('pk', flat=True)
+        buildResponseQuestionLookupTable.cache.invalidate(self.response_id, *response_ids)
         # delete response questions
         ResponseQuestion.objects.filter(response__user=user, response__survey_id=MENTEE_SURVEY_PK).delete()
         # delete response itself
@@ -162,30 +210,32 @@ class Mentee(models.Model):
         Match.objects.filter(mentee=self).delete()
         # delete the mentee
         super(Mentee, self).delete()
+        # the mentors this mentee was matched with have room now
+        for mentor_id in set(mentor_ids):
+            MatchScore.objects.refreshMentor(mentor_id)
 
     def scoreWith(self, mentor):
         """Score this mentee against the passed-in mentor object"""
-        q = buildResponseQuestionLookupTable(self.response, mentor.response)
-        return score(q, mentor)
+        ResponseFeatures.objects.attach([self, mentor])
+        return scoreMatrix([self.features], [mentor.features], [mentor.number_of_mentees], scoringPlan())[0][0]
 
-    def findSuitors(self, mentors):
+    def findSuitors(self, mentors, index=None):
         """Return a list of namedtuples of potential mentors and their scores,
-        ordered by the mentee's preference for the mentor"""
+        ordered by the mentee's preference for the mentor. If you're finding
+        the suitors for several mentees, pass in a suitorIndex() built from the
+        same list of mentors, so it is only built once"""
         Pair = namedtuple('Pair', 'mentor score')
-        suitors = []
-        for mentor in mentors:
-            s = self.scoreWith(mentor)
-            if s == -1:
-                break
-            # keep track of the mentor, and the score with that mentor
-            suitors.append(Pair(mentor, s))
-
-        # sort by the score first obviously, and for equal scores, order by the
-        # number of mentees (since a mentor with fewer mentees is preferred)
-        suitors.sort(key=lambda pair: (-pair.score, pair.mentor.number_of_mentees))
+        mentors = list(mentors)
+        if index is None:
+            index = suitorIndex(mentors)
+
+        ResponseFeatures.objects.attach([self])
+        # the index sorts by the score first obviously, and for equal scores,
+        # by the number of mentees (since a mentor with fewer mentees is
+        # preferred), and only looks at as many mentors as it has to
 
         # return the first 3 mentor picks
-        return suitors[0:3]
+        return [Pair(mentors[column], s) for column, s in index.top(self.features, 3)]
 
     class Meta:
         db_table = "mentee"
@@ -262,35 +312,200 @@ class MatchManager(models.Manager):
         # return the list of mentors
         return mentors_lookup.values()
 
+    # Each state change is one conditional statement, which only does
+    # something if the match is in the right state. They return True if the
+    # match changed, and False if it wasn't in that state (for example,
+    # because someone else changed it first).
+
+    def engage(self, mentor_id, mentee_id):
+        """Recommend the mentee to the mentor. Nothing happens if the mentor
+        has no room, the pair is already matched, or the mentee was removed"""
+        with transaction.atomic():
+            # lock the mentor, so two engagements can't both take his last spot
+            mentor = Mentor.objects.select_for_update().get(pk=mentor_id)
+            ResponseFeatures.objects.attach([mentor])
+            cursor = connection.cursor()
+            try:
+                with transaction.atomic():
+                    cursor.execute("""
+                        INSERT INTO `match` (mentor_id, mentee_id, engaged_on, is_deleted, is_active)
+                        SELECT
+                            %s, %s, %s, 0, 1
+                        FROM
+                            mentee
+                        WHERE
+                            mentee_id = %s AND
+                            is_deleted = 0 AND
+                            (
+                                SELECT COUNT(*) FROM `match`
+                                WHERE mentor_id = %s AND completed_on IS NULL AND is_deleted = 0
+                            ) < %s
+                    """, (mentor_id, mentee_id, timezone.now(), mentee_id, mentor_id, mentor.features.capacity))
+            except IntegrityError:
+                # the pair is already active
+                return False
+            engaged = cursor.rowcount == 1
+
+        if engaged:
+            MatchScore.objects.refreshMentor(mentor_id)
+        return engaged
+
     def marry(self, mentor_id, mentee_id):
         """Marry the mentor with the mentee"""
-        m = Match.objects.get(mentor_id=mentor_id, mentee_id=mentee_id)
-        mentor = Mentor.objects.get(pk=mentor_id)
-        mentee = Mentee.objects.get(pk=mentee_id)
         # simply set the married_on date to something not null to flag the
         # match as married
-        m.married_on = datetime.now()
-        m.save()
-        m.notify()
+        married = Match.objects.filter(
+            mentor_id=mentor_id,
+            mentee_id=mentee_id,
+            married_on__isnull=True,
+            completed_on__isnull=True
+        ).update(married_on=timezone.now()) == 1
+        if married:
+            Match(mentor_id=mentor_id, mentee_id=mentee_id).notify()
+        return married
 
     def divorce(self, mentor_id, mentee_id):
-        Match.objects.get(mentor_id=mentor_id, mentee_id=mentee_id).delete()
-
-    def engage(self, mentor_id, mentee_id):
-        m = Match()
-        m.mentor = Mentor.objects.get(pk=mentor_id)
-        m.mentee = Mentee.objects.get(pk=mentee_id)
-        m.save()
+        divorced = self._delete(mentor_id, mentee_id, "married_on IS NOT NULL")
+        if divorced:
+            # the mentor has one less mentee, so he may not be full anymore
+            MatchScore.objects.refreshMentor(mentor_id)
+        return divorced
 
     def breakup(self, mentor_id, mentee_id):
-        Match.objects.get(mentor_id=mentor_id, mentee_id=mentee_id).delete()
+        broken_up = self._delete(mentor_id, mentee_id, "married_on IS NULL")
+        if broken_up:
+            MatchScore.objects.refreshMentor(mentor_id)
+        return broken_up
 
     def complete(self, mentor_id, mentee_id):
-        match = Match.objects.get(mentor_id=mentor_id, mentee_id=mentee_id)
         # just set the completed_on date to something to flag this match as
-        # completed
-        match.completed_on = datetime.now()
-        match.save()
+        # completed (and it's not active anymore)
+        completed = Match.objects.filter(
+            mentor_id=mentor_id,
+            mentee_id=mentee_id,
+            married_on__isnull=False,
+            completed_on__isnull=True
+        ).update(completed_on=timezone.now(), is_active=None) == 1
+        if completed:
+            MatchScore.objects.refreshMentor(mentor_id)
+        return completed
+
+    # the actions apply() understands, in the order it applies them
+    ACTIONS = ("engage", "marry", "complete", "breakup", "divorce")
+
+    def apply(self, actions):
+        """Apply a list of (mentor_id, mentee_id, action) tuples (where action
+        is one of ACTIONS) in one transaction, with a few statements for each
+        kind of action instead of a few for each pair. Like the methods
+        above, an action only happens if the pair is in the right state.
+        Returns a list of (mentor_id, mentee_id, action, applied) tuples, in
+        the same order"""
+        actions = [(int(mentor_id), int(mentee_id), action) for mentor_id, mentee_id, action in actions]
+        pairs = defaultdict(list)
+        for mentor_id, mentee_id, action in actions:
+            if action not in self.ACTIONS:
+                raise ValueError("%s is not one of %s" % (action, ", ".join(self.ACTIONS)))
+            pairs[action].append((mentor_id, mentee_id))
+
+        applied = {}
+        with transaction.atomic():
+            applied["engage"] = self._engageAll(pairs["engage"])
+
+            marry = self._lockAll(pairs["marry"], married_on__isnull=True)
+            Match.objects.filter(pk__in=marry.values()).update(married_on=timezone.now())
+            applied["marry"] = set(marry)
+            # queue all the emails at once
+            notifications = []
+            for match in Match.objects.filter(pk__in=marry.values()).select_related("mentor__user", "mentee__user"):
+                notifications.extend(match.notifications())
+            Outbox.objects.bulk_create(notifications)
+
+            complete = self._lockAll(pairs["complete"], married_on__isnull=False)
+            Match.objects.filter(pk__in=complete.values()).update(completed_on=timezone.now(), is_active=None)
+            applied["complete"] = set(complete)
+
+            for action, married in (("breakup", False), ("divorce", True)):
+                delete = self._lockAll(pairs[action], married_on__isnull=not married)
+                Match.objects.filter(pk__in=delete.values()).delete()
+                applied[action] = set(delete)
+
+        # refresh each mentor whose number of mentees changed once
+        changed = set()
+        for action in ("engage", "complete", "breakup", "divorce"):
+            changed.update(mentor_id for mentor_id, mentee_id in applied[action])
+        for mentor_id in changed:
+            MatchScore.objects.refreshMentor(mentor_id)
+
+        results = []
+        for mentor_id, mentee_id, action in actions:
+            # if a pair is listed twice, only the first one counts
+            done = (mentor_id, mentee_id) in applied[action]
+            applied[action].discard((mentor_id, mentee_id))
+            results.append((mentor_id, mentee_id, action, done))
+        return results
+
+    def _engageAll(self, pairs):
+        """Engage each (mentor_id, mentee_id) pair that isn't matched yet, as
+        long as the mentor has room. Returns the set of pairs engaged"""
+        if not pairs:
+            return set()
+        mentor_ids = set(mentor_id for mentor_id, mentee_id in pairs)
+        mentee_ids = set(mentee_id for mentor_id, mentee_id in pairs)
+        # lock the mentors, like engage() does
+        mentors = dict((mentor.pk, mentor) for mentor in Mentor.objects.select_for_update().filter(pk__in=mentor_ids))
+        ResponseFeatures.objects.attach(mentors.values())
+        mentees = set(Mentee.objects.filter(pk__in=mentee_ids, is_deleted=False).values_list("pk", flat=True))
+        counts = defaultdict(int, Match.objects.filter(
+            mentor_id__in=mentor_ids,
+            completed_on__isnull=True,
+            is_deleted=False
+        ).values_list("mentor_id").annotate(models.Count("pk")))
+        active = set(Match.objects.filter(
+            mentor_id__in=mentor_ids,
+            mentee_id__in=mentee_ids,
+            is_active=True
+        ).values_list("mentor_id", "mentee_id"))
+
+        engaged = set()
+        for mentor_id, mentee_id in pairs:
+            if mentor_id not in mentors or mentee_id not in mentees or (mentor_id, mentee_id) in active:
+                continue
+            if counts[mentor_id] >= mentors[mentor_id].features.capacity:
+                continue
+            counts[mentor_id] += 1
+            active.add((mentor_id, mentee_id))
+            engaged.add((mentor_id, mentee_id))
+        self.bulk_create([Match(mentor_id=mentor_id, mentee_id=mentee_id) for mentor_id, mentee_id in engaged])
+        return engaged
+
+    def _lockAll(self, pairs, **filters):
+        """Lock the active matches for the (mentor_id, mentee_id) pairs that
+        also meet the filters. Returns a dict of pair -> match_id"""
+        if not pairs:
+            return {}
+        wanted = set(pairs)
+        matches = self.select_for_update().filter(
+            mentor_id__in=set(mentor_id for mentor_id, mentee_id in pairs),
+            mentee_id__in=set(mentee_id for mentor_id, mentee_id in pairs),
+            completed_on__isnull=True,
+            is_deleted=False,
+            **filters
+        ).values_list("mentor_id", "mentee_id", "pk")
+        return dict(((mentor_id, mentee_id), pk) for mentor_id, mentee_id, pk in matches if (mentor_id, mentee_id) in wanted)
+
+    def _delete(self, mentor_id, mentee_id, condition):
+        """Delete the pair's active match if it meets the condition (a bit of
+        SQL). Returns True if it was deleted"""
+        cursor = connection.cursor()
+        cursor.execute("""
+            DELETE FROM `match`
+            WHERE
+                mentor_id = %s AND
+                mentee_id = %s AND
+                completed_on IS NULL AND
+                is_deleted = 0 AND
+        """ + condition, (mentor_id, mentee_id))
+        return cursor.rowcount == 1
 
 class Match(models.Model):
     match_id = models.AutoField(primary_key=True)
@@ -300,17 +515,25 @@ class Match(models.Model):
     married_on = models.DateTimeField(null=True, default=None, blank=True)
     completed_on = models.DateTimeField(null=True, default=None, blank=True)
     is_deleted = models.BooleanField(default=False, blank=True)
+    # True until the match is completed, and then NULL, so the unique index
+    # only allows one active match for each pair
+    is_active = models.NullBooleanField(default=True)
 
     def notify(self):
-        settings = Settings.objects.default()
+        Outbox.objects.bulk_create(self.notifications())
+
+    def notifications(self):
+        """Return the (unsaved) Outbox emails that tell the mentor and mentee
+        they were matched, or nothing if emails are turned off"""
+        settings = Settings.objects.cached()
         # don't notify if we aren't supposed to
         if not settings.send_email:
-            return
+            return []
 
         mentee = self.mentee
         mentor = self.mentor
-        mentor_template = Template(settings.mentor_body)
-        mentee_template = Template(settings.mentee_body)
+        mentor_template = settings.mentor_template
+        mentee_template = settings.mentee_template
         mentor_subject = settings.mentor_subject
         mentee_subject = settings.mentee_subject
 
@@ -326,72 +549,736 @@ class Match(models.Model):
         mentor_body = mentor_template.render(c)
         mentee_body = mentee_template.render(c)
 
-        # send email
-        send_mail(mentor_subject, mentor_body, 'no-reply@pdx.edu', [mentor.user.email])
-        send_mail(mentee_subject, mentee_body, 'no-reply@pdx.edu', [mentee.user.email])
+        # the sendoutbox command sends them
+        return [
+            Outbox.objects.message(mentor_subject, mentor_body, 'no-reply@pdx.edu', [mentor.user.email]),
+            Outbox.objects.message(mentee_subject, mentee_body, 'no-reply@pdx.edu', [mentee.user.email]),
+        ]
 
     class Meta:
         db_table = "match"
+        unique_together = (("mentor", "mentee", "is_active"),)
+        # for counting a mentor's current mentees (withMenteeCount,
+        # getResponses), and finding a mentee's match (unmatched)
+        index_together = (
+            ("mentor", "is_deleted", "completed_on"),
+            ("mentee", "is_deleted"),
+        )
 
     objects = MatchManager()
 
-def buildResponseQuestionLookupTable(response_a, response_b):
-    """Build a dictionary where the key is a question id, and the value is the
-    of the ResponseQuestion object for that question, with a special "value" or
-    "values" attribute. Include the ResponseQuestion objects from the
-    response_a and response_b Response objects"""
+class OutboxManager(models.Manager):
+    def message(self, subject, message, from_email, recipient_list):
+        """Return an unsaved Outbox email, for queueing many at once with
+        bulk_create()"""
+        return Outbox(subject=subject, body=message, from_email=from_email, to=",".join(recipient_list))
+
+    def enqueue(self, subject, message, from_email, recipient_list):
+        """Queue an email to be sent by the sendoutbox command. It takes the
+        same arguments as send_mail(), and it is saved in the current
+        transaction, so it is only sent if the transaction commits"""
+        outbox = self.message(subject, message, from_email, recipient_list)
+        outbox.save()
+        return outbox
+
+    def deliver(self, batch_size=100):
+        """Send up to batch_size of the emails that are due, over a single
+        connection to the mail server. An email that can't be sent is tried
+        again later, waiting twice as long after each failure, until it has
+        failed MAX_ATTEMPTS times. Returns the number of emails that were tried
+        (sent or not), so a full batch means there may be more to send. If the
+        mail server can't be reached, it returns 0"""
+        now = timezone.now()
+        with transaction.atomic():
+            # lock the batch, so two workers can't send the same email
+            messages = list(self.select_for_update().filter(
+                sent_on__isnull=True,
+                attempts__lt=Outbox.MAX_ATTEMPTS,
+                send_after__lte=now,
+            ).order_by("pk")[:batch_size])
+            if not messages:
+                return 0
+
+            mail_connection = get_connection()
+            try:
+                mail_connection.open()
+            except Exception as e:
+                for message in messages:
+                    message.failed(e, now)
+                return 0
+
+            try:
+                for message in messages:
+                    try:
+                        EmailMessage(message.subject, message.body, message.from_email, message.to.split(","), connection=mail_connection).send()
+                    except Exception as e:
+                        message.failed(e, now)
+                    else:
+                        message.sent_on = now
+                        message.save()
+            finally:
+                mail_connection.close()
+
+        return len(messages)
+
+class Outbox(models.Model):
+    """An email waiting to be sent (see OutboxManager.deliver())"""
+    # give up on an email after this many tries
+    MAX_ATTEMPTS = 8
+    # seconds to wait after the first failure (it doubles after each one)
+    RETRY_DELAY = 60
+
+    outbox_id = models.AutoField(primary_key=True)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    # comma separated list of email addresses
+    to = models.TextField()
+    created_on = models.DateTimeField(auto_now_add=True)
+    send_after = models.DateTimeField(default=timezone.now)
+    sent_on = models.DateTimeField(null=True, default=None, blank=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    objects = OutboxManager()
+
+    def failed(self, error, now):
+        """Note that sending failed, and when to try again"""
+        self.attempts += 1
+        self.last_error = repr(error)
+        self.send_after = now + timedelta(seconds=self.RETRY_DELAY * 2 ** (self.attempts - 1))
+        self.save()
 
-    if response_a.survey_id == response_b.survey_id:
-        raise ValueError("response_a.survey_id cannot be the same as response_b.survey_id")
+    class Meta:
+        db_table = "outbox"
 
-    # building the lookup table all at once drastically improves performance
-    if buildResponseQuestionLookupTable.cache == {}:
-        rows = ResponseQuestion.objects.raw("""
+class FeatureValue(models.Model):
+    """Assigns a permanent code to each distinct answer value used by the
+    scoring features (see StoredVocabulary)"""
+    feature_value_id = models.AutoField(primary_key=True)
+    kind = models.CharField(max_length=32)
+    value = models.CharField(max_length=255)
+    code = models.IntegerField()
+
+    class Meta:
+        db_table = "feature_value"
+        unique_together = (("kind", "value"), ("kind", "code"))
+
+class StoredVocabulary(Vocabulary):
+    """A Vocabulary whose codes are saved in the feature_value table, so they
+    mean the same thing in every process, and bitmasks built with them can be
+    stored. Codes are never reassigned, so it is safe to keep one of these
+    around for the life of the process. None always gets the code 0"""
+    def __init__(self, kind):
+        super(StoredVocabulary, self).__init__()
+        self.kind = kind
+        self.reload()
+
+    def reload(self):
+        self[None] = 0
+        for value, code in FeatureValue.objects.filter(kind=self.kind).values_list("value", "code"):
+            self[value] = code
+
+    def code(self, value):
+        try:
+            return self[value]
+        except KeyError:
+            pass
+
+        # someone else may have added it
+        self.reload()
+        if value in self:
+            return self[value]
+
+        code = len(self)
+        try:
+            with transaction.atomic():
+                FeatureValue.objects.create(kind=self.kind, value=value, code=code)
+        except IntegrityError:
+            # we lost a race for this code, so try again
+            return self.code(value)
+
+        self[value] = code
+        return code
+
+def vocabulary(kind):
+    """Return the StoredVocabulary for this kind of feature"""
+    if kind not in vocabulary.cache:
+        vocabulary.cache[kind] = StoredVocabulary(kind)
+    return vocabulary.cache[kind]
+
+vocabulary.cache = {}
+
+def featureEncoder():
+    """Return a FeatureEncoder that uses the stored vocabularies"""
+    return FeatureEncoder(
+        fields_of_study=vocabulary("field_of_study"),
+        interests=vocabulary("interest"),
+        genders=vocabulary("gender"),
+    )
+
+class BitmaskField(models.TextField):
+    """Stores an arbitrarily large bitmask as a hex string"""
+    __metaclass__ = models.SubfieldBase
+
+    def to_python(self, value):
+        if isinstance(value, (int, long)):
+            return value
+        if not value:
+            return 0
+        return int(value, 16)
+
+    def get_prep_value(self, value):
+        return "%x" % (value or 0)
+
+class ResponseFeaturesManager(models.Manager):
+    def compile(self, response):
+        """Encode the response, and save (or update) its features"""
+        features = self.encode([response])[response.pk]
+        instance = ResponseFeatures.fromFeatures(response.pk, features)
+        instance.save()
+        return instance
+
+    def encode(self, responses):
+        """Encode each response in the list into Features, reading its answers
+        from response_question. Returns a dict of response_id -> Features"""
+        encoder = featureEncoder()
+        lookup = loadResponseQuestions([response.pk for response in responses])
+        encoded = {}
+        for response in responses:
+            q = QuestionDict(lookup.get(response.pk, {}))
+            if response.survey_id == MENTOR_SURVEY_PK:
+                encoded[response.pk] = encoder.encodeMentor(q)
+            else:
+                encoded[response.pk] = encoder.encodeMentee(q)
+        return encoded
+
+    def features(self, response_ids):
+        """Return a dict of response_id -> Features for each response id. Any
+        response that doesn't have its features compiled yet gets compiled
+        (and saved) now"""
+        response_ids = list(response_ids)
+        found = dict((rf.pk, rf.toFeatures()) for rf in self.filter(pk__in=response_ids))
+        missing = [response_id for response_id in response_ids if response_id not in found]
+        if missing:
+            encoded = self.encode(list(Response.objects.filter(pk__in=missing)))
+            try:
+                with transaction.atomic():
+                    self.bulk_create([ResponseFeatures.fromFeatures(pk, features) for pk, features in encoded.items()])
+            except IntegrityError:
+                # another request compiled some of them first, so use theirs
+                # (the rest are compiled again next time)
+                found.update((rf.pk, rf.toFeatures()) for rf in self.filter(pk__in=missing))
+            for pk, features in encoded.items():
+                found.setdefault(pk, features)
+        return found
+
+    def attach(self, objects):
+        """Set a features attribute on each object (anything with a response_id)
+        that doesn't have one yet"""
+        needed = [obj for obj in objects if not hasattr(obj, "features")]
+        if needed:
+            features = self.features(set(obj.response_id for obj in needed))
+            for obj in needed:
+                obj.features = features[obj.response_id]
+
+class ResponseFeatures(models.Model):
+    """The compiled Features (see scoring.py) for a mentor or mentee response.
+    Scoring reads these instead of the response_question table"""
+    response = models.OneToOneField(Response, primary_key=True, related_name="+")
+    has_mentor_in_mind = models.BooleanField(default=False)
+    capacity = models.SmallIntegerField()
+    fields_of_study = BitmaskField()
+    field_of_study_preference = BitmaskField()
+    gender = models.SmallIntegerField()
+    gender_preference = models.SmallIntegerField()
+    availability = models.SmallIntegerField()
+    skills_wanted = models.IntegerField()
+    skill_ratings = models.CommaSeparatedIntegerField(max_length=255)
+    interests = BitmaskField()
+
+    objects = ResponseFeaturesManager()
+
+    @classmethod
+    def fromFeatures(cls, response_id, features):
+        values = features._asdict()
+        values['skill_ratings'] = ",".join(str(rating) for rating in features.skill_ratings)
+        return cls(response_id=response_id, **values)
+
+    def toFeatures(self):
+        return Features(
+            has_mentor_in_mind=self.has_mentor_in_mind,
+            capacity=self.capacity,
+            fields_of_study=self.fields_of_study,
+            field_of_study_preference=self.field_of_study_preference,
+            gender=self.gender,
+            gender_preference=self.gender_preference,
+            availability=self.availability,
+            skills_wanted=self.skills_wanted,
+            skill_ratings=tuple(int(rating) for rating in self.skill_ratings.split(",")),
+            interests=self.interests,
+        )
+
+    class Meta:
+        db_table = "response_features"
+
+def _breakdowns():
+    """True if score breakdowns should be computed and stored"""
+    return getattr(SETTINGS, "MATCH_SCORE_BREAKDOWN", True)
+
+def _scoreFeatures(mentees, mentors, mentee_counts, processes=1):
+    """Score the features with the scoringPlan(), like scoreMatrix(). Returns
+    the scores and their breakdowns. The breakdowns are only computed when
+    MATCH_SCORE_BREAKDOWN is on (they are all None otherwise), since that
+    takes more than twice as long"""
+    if _breakdowns():
+        return parallelScoreMatrix(mentees, mentors, mentee_counts, scoringPlan(), processes=processes, breakdown=True)
+    scores = parallelScoreMatrix(mentees, mentors, mentee_counts, scoringPlan(), processes=processes)
+    return scores, [[None] * len(mentors) for row in scores]
+
+class MatchScoreManager(models.Manager):
+    def refreshMentor(self, mentor_id):
+        """Recompute the scores of every mentee with this mentor. Call this when
+        the mentor's survey, or the number of mentees he has, changes"""
+        mentor = Mentor.objects.get(pk=mentor_id)
+        mentor.number_of_mentees = Match.objects.filter(mentor_id=mentor_id, completed_on__isnull=True).count()
+        mentees = list(Mentee.objects.filter(is_deleted=False))
+        ResponseFeatures.objects.attach(mentees + [mentor])
+        scores, breakdowns = _scoreFeatures(
+            [mentee.features for mentee in mentees],
+            [mentor.features],
+            [mentor.number_of_mentees],
+        )
+        self.filter(mentor_id=mentor_id).delete()
+        self.bulk_create([
+            MatchScore(mentee_id=mentee.pk, mentor_id=mentor_id, score=row[0], breakdown=packed[0])
+            for mentee, row, packed in zip(mentees, scores, breakdowns)
+        ])
+
+    def refreshMentee(self, mentee_id):
+        """Recompute the scores of every mentor with this mentee. Call this when
+        the mentee's survey changes"""
+        mentee = Mentee.objects.get(pk=mentee_id)
+        mentors = list(Mentor.objects.withMenteeCount())
+        ResponseFeatures.objects.attach([mentee] + mentors)
+        scores, breakdowns = _scoreFeatures(
+            [mentee.features],
+            [mentor.features for mentor in mentors],
+            [mentor.number_of_mentees for mentor in mentors],
+        )
+        self.filter(mentee_id=mentee_id).delete()
+        self.bulk_create([
+            MatchScore(mentee_id=mentee_id, mentor_id=mentor.pk, score=s, breakdown=packed)
+            for mentor, s, packed in zip(mentors, scores[0], breakdowns[0])
+        ])
+
+    def tile(self, mentees, mentors):
+        """Return the scores of each mentee (one row each) with each mentor
+        (one column each), read from the match_score table in one query. Any
+        pairs that are missing from the table are scored and saved"""
+        mentees = list(mentees)
+        mentors = list(mentors)
+        if not mentees or not mentors:
+            return [[] for mentee in mentees]
+
+        stored = dict(((mentee_id, mentor_id), s) for mentee_id, mentor_id, s in self.filter(
+            mentee_id__in=[mentee.pk for mentee in mentees],
+            mentor_id__in=[mentor.pk for mentor in mentors],
+        ).values_list("mentee_id", "mentor_id", "score"))
+
+        if len(stored) < len(mentees) * len(mentors):
+            # the number of mentees each mentor has (like refreshMentor())
+            counts = dict(Match.objects.filter(
+                mentor_id__in=[mentor.pk for mentor in mentors],
+                completed_on__isnull=True
+            ).values_list("mentor_id").annotate(models.Count("pk")))
+            for mentor in mentors:
+                mentor.number_of_mentees = counts.get(mentor.pk, 0)
+            ResponseFeatures.objects.attach(mentees + mentors)
+            scores, breakdowns = _scoreFeatures(
+                [mentee.features for mentee in mentees],
+                [mentor.features for mentor in mentors],
+                [mentor.number_of_mentees for mentor in mentors],
+                processes=getattr(SETTINGS, "MATCH_SCORING_PROCESSES", 1),
+            )
+            missing = []
+            for mentee, row, packed_row in zip(mentees, scores, breakdowns):
+                for mentor, s, packed in zip(mentors, row, packed_row):
+                    if (mentee.pk, mentor.pk) not in stored:
+                        stored[(mentee.pk, mentor.pk)] = s
+                        missing.append(MatchScore(mentee_id=mentee.pk, mentor_id=mentor.pk, score=s, breakdown=packed))
+            try:
+                with transaction.atomic():
+                    self.bulk_create(missing)
+            except IntegrityError:
+                # another request saved them first
+                pass
+
+        return [[stored[(mentee.pk, mentor.pk)] for mentor in mentors] for mentee in mentees]
+
+    def version(self):
+        """Return a string that changes whenever the scores, or the mentors
+        and mentees being scored, could have changed: a new or edited response, a match
+        being made, finalized, completed or broken up, someone being removed,
+        or the scoring profile changing"""
+        cursor = connection.cursor()
+        cursor.execute("""
             SELECT
-                response_question.response_question_id,
-                question.type,
-                response_question.question_id,
-                response_id,
-                IF(response_question.choice_id IS NULL, response_question.value, choice.value) AS value
-            FROM
-                response_question
-            LEFT JOIN
-                choice
-            ON
-                response_question.choice_id = choice.choice_id
-            INNER JOIN
-                question
-            ON 
-                question.question_id = response_question.question_id
+                (SELECT MAX(response_id) FROM response),
+                (SELECT MAX(updated_on) FROM response),
+                (SELECT COUNT(*) FROM `match`),
+                (SELECT MAX(match_id) FROM `match`),
+                (SELECT MAX(married_on) FROM `match`),
+                (SELECT MAX(completed_on) FROM `match`),
+                (SELECT COUNT(*) FROM mentor WHERE is_deleted = 0),
+                (SELECT COUNT(*) FROM mentee WHERE is_deleted = 0),
+                (SELECT MAX(scoring_profile_id) FROM scoring_profile WHERE is_active = 1),
+                (SELECT MAX(version) FROM scoring_profile WHERE is_active = 1)
         """)
+        return ":".join(str(value) for value in cursor.fetchone())
 
-        # for each ResponseQuestion row, add it to the question_values map if it
-        # doesn't exist. For checkbox questions, attach a values attribute, and
-        # make it a list that includes all the values selected for that question
-        for row in rows:
-            question_values = buildResponseQuestionLookupTable.cache[row.response_id]
-            if row.question_id not in question_values:
-                question_values[row.question_id] = row
-                # for checkbox questions, it will have a "values" attribute that is
-                # a list of values selected for that question
-                if Question.isMultiValuedType(row.type):
-                    row.values = [row.value]
+class MatchScore(models.Model):
+    """The score of each mentee and mentor pair, so the whole grid doesn't have
+    to be scored every time the match page is loaded. It is kept up to date
+    as surveys are submitted, and matches are made"""
+    match_score_id = models.AutoField(primary_key=True)
+    mentee = models.ForeignKey(Mentee, related_name="+")
+    mentor = models.ForeignKey(Mentor, related_name="+")
+    score = models.SmallIntegerField()
+    # the points for each of the COMPONENTS, packed by packBreakdown() (or
+    # NULL when MATCH_SCORE_BREAKDOWN is off)
+    breakdown = models.BigIntegerField(null=True)
+
+    objects = MatchScoreManager()
+
+    def parts(self):
+        """Return an OrderedDict of component -> points, or None if there is
+        no breakdown"""
+        if self.breakdown is None:
+            return None
+        return OrderedDict(zip(COMPONENTS, unpackBreakdown(self.breakdown)))
+
+    class Meta:
+        db_table = "match_score"
+        unique_together = (("mentee", "mentor"),)
+
+class ScoringProfile(models.Model):
+    """A set of ScoringRules that decide how mentees and mentors are scored.
+    Only one profile is active at a time. If none is, the built in rules
+    (DEFAULT_RULES in scoring.py) are used"""
+    scoring_profile_id = models.AutoField(primary_key=True)
+    name = models.CharField(max_length=255)
+    is_active = models.BooleanField(default=False, blank=True, help_text="Use this profile to score matches")
+    # bumped every time the profile or one of its rules changes, so each
+    # process knows when to recompile its Plan
+    version = models.IntegerField(default=0, editable=False)
+
+    def __unicode__(self):
+        return self.name
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self.is_active:
+                ScoringProfile.objects.exclude(pk=self.pk).filter(is_active=True).update(is_active=False)
+            if self.pk is None:
+                self.version += 1
             else:
-                # if we're in this branch, it MUST be a checkbox, or select
-                # multiple question, or there is a bug somewhere.
-                if Question.isMultiValuedType(row.type):
-                    # append the value for this ResponseQuestion to the list of
-                    # values
-                    question_values[row.question_id].values.append(row.value)
+                # bump it in the database, so a touch() at the same time isn't lost
+                self.version = models.F("version") + 1
+            super(ScoringProfile, self).save(*args, **kwargs)
+            self.version = ScoringProfile.objects.values_list("version", flat=True).get(pk=self.pk)
+            # every stored score may be different now
+            MatchScore.objects.all().delete()
+
+    def delete(self, *args, **kwargs):
+        super(ScoringProfile, self).delete(*args, **kwargs)
+        MatchScore.objects.all().delete()
+
+    def touch(self):
+        """Note that one of the rules changed"""
+        ScoringProfile.objects.filter(pk=self.pk).update(version=models.F("version") + 1)
+        MatchScore.objects.all().delete()
+
+    def rules(self):
+        return [rule.toRule() for rule in self.scoringrule_set.all()]
+
+    class Meta:
+        db_table = "scoring_profile"
+
+class ScoringRule(models.Model):
+    """Award points when a feature of the mentee compares favorably with a
+    feature of the mentor (see Rule in scoring.py)"""
+    KIND_CHOICES = (
+        (OVERLAP, "Have something in common"),
+        (EQUAL, "Are the same (or one is the wildcard)"),
+        (AT_LEAST, "Mentor's is at least as high"),
+        (LIKERT, "Mentor rates the skill at least the threshold"),
+    )
+    ROLE_CHOICES = [(role, role.replace("_", " ").capitalize()) for role in sorted(ROLE_TYPES)]
+
+    scoring_rule_id = models.AutoField(primary_key=True)
+    profile = models.ForeignKey(ScoringProfile)
+    kind = models.IntegerField(choices=KIND_CHOICES)
+    mentee_role = models.CharField(max_length=32, choices=ROLE_CHOICES)
+    mentor_role = models.CharField(max_length=32, choices=ROLE_CHOICES)
+    points = models.PositiveSmallIntegerField()
+    partial_points = models.PositiveSmallIntegerField(default=0, help_text="Points when one side matches, and the other side's is the wildcard")
+    threshold = models.SmallIntegerField(default=0, help_text="The lowest likert rating that counts")
+    mutual = models.BooleanField(default=False, blank=True, help_text="The mentor's mentee role has to match the mentee's mentor role too")
+    wildcard = models.CharField(max_length=255, blank=True, help_text="The answer that means \"I don't care\"")
+
+    def toRule(self):
+        return Rule(self.kind, self.mentee_role, self.mentor_role, self.points, self.partial_points, self.threshold, self.mutual, self.wildcard or None)
+
+    def clean(self):
+        try:
+            checkRule(self.toRule())
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+    def save(self, *args, **kwargs):
+        super(ScoringRule, self).save(*args, **kwargs)
+        self.profile.touch()
+
+    def delete(self, *args, **kwargs):
+        super(ScoringRule, self).delete(*args, **kwargs)
+        self.profile.touch()
+
+    class Meta:
+        db_table = "scoring_rule"
+        ordering = ["scoring_rule_id"]
+
+def scoringPlan():
+    """Return the compiled Plan (see scoring.py) for the active ScoringProfile.
+    The profile is only compiled again when it changes, which costs one small
+    query to find out"""
+    try:
+        key = ScoringProfile.objects.filter(is_active=True).values_list("pk", "version")[0]
+    except IndexError:
+        key = None
+
+    if scoringPlan.cache.get("key", ()) != key:
+        if key is None:
+            rules = DEFAULT_RULES
+        else:
+            rules = ScoringProfile(pk=key[0]).rules()
+        scoringPlan.cache = {
+            "key": key,
+            "plan": Plan(rules, vocabulary("gender").code),
+        }
+    return scoringPlan.cache["plan"]
+
+scoringPlan.cache = {}
+
+def buildResponseQuestionLookupTable(response_a, response_b):
+    """Build a dictionary where the key is a question id, and the value is the
+    Answer for that question, with a "value" and "values" attribute. Include
+    the answers from the response_a and response_b Response objects"""
+
+    if response_a.survey_id == response_b.survey_id:
+        raise ValueError("response_a.survey_id cannot be the same as response_b.survey_id")
 
     # convert to q QuestionDict
     a = {}
-    a.update(buildResponseQuestionLookupTable.cache[response_a.pk])
-    a.update(buildResponseQuestionLookupTable.cache[response_b.pk])
+    a.update(lookupResponseQuestions(response_a.pk))
+    a.update(lookupResponseQuestions(response_b.pk))
     return QuestionDict(a)
 
-
-buildResponseQuestionLookupTable.cache = defaultdict(dict)
+# a compact version of a ResponseQuestion. For checkbox and select multiple
+# questions, values is a tuple of every value selected (and value is the first
+# one). For everything else, values is empty
+Answer = namedtuple('Answer', 'value values')
+
+def loadResponseQuestions(response_ids=None):
+    """Return a dict where the key is a response id, and the value is a dict of
+    question_id -> Answer for that response. If response_ids is None, the
+    responses of every mentor and mentee (that isn't deleted) are loaded"""
+    if response_ids is None:
+        where_clause = """
+            WHERE response_question.response_id IN (
+                SELECT response_id FROM mentor WHERE is_deleted = 0
+                UNION
+                SELECT response_id FROM mentee WHERE is_deleted = 0
+            )
+        """
+        params = []
+    else:
+        if not response_ids:
+            return {}
+        where_clause = "WHERE response_question.response_id IN (%s)" % (",".join(["%s"] * len(response_ids)))
+        params = list(response_ids)
+
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT
+            response_question.response_id,
+            response_question.question_id,
+            question.type,
+            IF(response_question.choice_id IS NULL, response_question.value, choice.value) AS value
+        FROM
+            response_question
+        LEFT JOIN
+            choice
+        ON
+            response_question.choice_id = choice.choice_id
+        INNER JOIN
+            question
+        ON 
+            question.question_id = response_question.question_id
+        """ + where_clause, params)
+
+    lookup = defaultdict(dict)
+    # for each row, add it to the question_values map if it doesn't exist. For
+    # checkbox questions, collect all the values selected for that question
+    multi_values = defaultdict(list)
+    for response_id, question_id, type_, value in cursor.fetchall():
+        question_values = lookup[response_id]
+        if question_id not in question_values:
+            question_values[question_id] = Answer(value, ())
+        # if the question was already seen, it MUST be a checkbox, or select
+        # multiple question, or there is a bug somewhere.
+        if Question.isMultiValuedType(type_):
+            multi_values[(response_id, question_id)].append(value)
+
+    for (response_id, question_id), values in multi_values.items():
+        answer = lookup[response_id][question_id]
+        lookup[response_id][question_id] = Answer(answer.value, tuple(values))
+
+    return lookup
+
+class ResponseQuestionCache(object):
+    """Holds the answers (see loadResponseQuestions()) for up to max_size
+    responses. The first lookup loads the answers for every current mentor and
+    mentee in one query, and after that, responses are loaded one at a time
+    when they are missing. The least recently used responses are evicted when
+    the cache is full"""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.primed = False
+        self.lock = threading.Lock()
+
+    def get(self, response_id):
+        with self.lock:
+            if not self.primed:
+                self.primed = True
+                for key, answers in loadResponseQuestions().items():
+                    self._put(key, answers)
+
+            try:
+                # move it to the end, since it was just used
+                answers = self.entries.pop(response_id)
+            except KeyError:
+                answers = loadResponseQuestions([response_id]).get(response_id, {})
+            self._put(response_id, answers)
+            return answers
+
+    def _put(self, response_id, answers):
+        self.entries[response_id] = answers
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, *response_ids):
+        """Forget the answers for these responses, so they are loaded fresh
+        the next time they are needed"""
+        with self.lock:
+            for response_id in response_ids:
+                self.entries.pop(response_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.primed = False
+
+def lookupResponseQuestions(response_id):
+    """Return a dict where the key is a question id, and the value is the
+    Answer for that question for a single response"""
+    return buildResponseQuestionLookupTable.cache.get(response_id)
+
+buildResponseQuestionLookupTable.cache = ResponseQuestionCache(getattr(SETTINGS, "RESPONSE_QUESTION_CACHE_SIZE", 5000))
+
+@receiver(response_changed)
+def responseChanged(sender, response, question_ids, **kwargs):
+    """Forget the response's cached answers, and recompile its features if
+    any of the questions they are based on changed"""
+    buildResponseQuestionLookupTable.cache.invalidate(response.pk)
+    if question_ids & SCORED_QUESTIONS:
+        ResponseFeatures.objects.compile(response)
+
+def archiveResponses(before, batch_size=500):
+    """Move up to batch_size superseded responses (see Response.is_latest)
+    created before the before datetime, and their answers, to the archive
+    tables, in one short transaction. A response a mentor or mentee still
+    points at is never moved. Returns the number of responses and
+    response_question rows moved (0 responses means there are none left)"""
+    with transaction.atomic():
+        response_ids = list(Response.objects.select_for_update().filter(
+            is_latest__isnull=True,
+            created_on__lt=before,
+        ).exclude(
+            # the base managers include the removed (is_deleted) mentors and
+            # mentees, who still point at their responses too
+            pk__in=Mentor._base_manager.values("response_id")
+        ).exclude(
+            pk__in=Mentee._base_manager.values("response_id")
+        ).order_by("pk").values_list("pk", flat=True)[:batch_size])
+        if not response_ids:
+            return 0, 0
+
+        in_clause = "IN (%s)" % (",".join(["%s"] * len(response_ids)))
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO response_archive (response_id, created_on, archived_on, user_id, survey_id)
+            SELECT response_id, created_on, %s, user_id, survey_id FROM response
+            WHERE response_id """ + in_clause, [timezone.now()] + response_ids)
+        cursor.execute("""
+            INSERT INTO response_question_archive (response_question_id, value, response_id, question_id, choice_id)
+            SELECT response_question_id, value, response_id, question_id, choice_id FROM response_question
+            WHERE response_id """ + in_clause, response_ids)
+        moved = cursor.rowcount
+        cursor.execute("DELETE FROM response_question WHERE response_id " + in_clause, response_ids)
+        cursor.execute("DELETE FROM response_features WHERE response_id " + in_clause, response_ids)
+        cursor.execute("DELETE FROM response_document WHERE response_id " + in_clause, response_ids)
+        cursor.execute("DELETE FROM response WHERE response_id " + in_clause, response_ids)
+
+    buildResponseQuestionLookupTable.cache.invalidate(*response_ids)
+    return len(response_ids), moved
+
+def suitorIndex(mentors):
+    """Build a SuitorIndex (see scoring.py) for the mentors, which must have the
+    number_of_mentees attribute (like the ones from
+    MentorManager.withMenteeCount())"""
+    ResponseFeatures.objects.attach(mentors)
+    return SuitorIndex(
+        [mentor.features for mentor in mentors],
+        [mentor.number_of_mentees for mentor in mentors],
+        scoringPlan()
+    )
+
+Proposal = namedtuple('Proposal', 'mentee mentor score')
+
+def proposeAssignment(mentees, mentors, solver=optimalAssignment):
+    """Use the solver (from assignment.py) to pair up the mentees with the
+    mentors (which must have the number_of_mentees attribute, like the ones
+    from MentorManager.withMenteeCount()). Returns a list of Proposals, one
+    for each mentee that was assigned a mentor"""
+    mentees = list(mentees)
+    mentors = list(mentors)
+    ResponseFeatures.objects.attach(mentees + mentors)
+    scores = scoreMatrix(
+        [mentee.features for mentee in mentees],
+        [mentor.features for mentor in mentors],
+        [mentor.number_of_mentees for mentor in mentors],
+        scoringPlan()
+    )
+    # how many more mentees each mentor can take
+    capacities = [max(0, int(mentor.features.capacity - mentor.number_of_mentees)) for mentor in mentors]
+
+    proposals = []
+    for mentee, row, column in zip(mentees, scores, solver(scores, capacities)):
+        if column is not None:
+            proposals.append(Proposal(mentee, mentors[column], row[column]))
+    return proposals
 
 class QuestionDict(dict):
     """This dict will return an object of type BlankItem when the key to the
@@ -0,0 +1,566 @@
+import heapq
+import multiprocessing
+from collections import defaultdict, namedtuple
+
+# This module scores every mentee against every mentor in one batch. Instead of
+# building a QuestionDict and a handful of sets for each pair (like score()
+# does), each response is encoded exactly once into a Features tuple, where
+# the multi-valued questions become bitmasks, and the single valued questions
+# become small ints. Scoring a pair is then just a few integer operations.
+#
+# What gets compared, and how many points it is worth, is a list of Rules
+# (which staff can edit as a ScoringProfile). The rules are compiled into a
+# Plan once, and the Plan does the actual scoring. DEFAULT_RULES mirror the
+# weights in score(). If you change one, change the other.
+
+###########
+# Weights #
+###########
+
+MATCHING_FIELD_OF_STUDY_PREFERENCE = 10
+MATCHING_GENDER_PREFERENCE = 5
+MATCHING_GENDER_ONE_SIDED = 3
+MATCHING_AVAILABILITY = 3
+# points for each skill the mentee wants, that the mentor is good at
+MATCHING_SKILL = 2
+# the mentor has to rate himself at least this high on the likert
+MATCHING_SKILL_LEVEL = 3
+MATCHING_INTERESTS = 1
+
+# the value of a gender preference question that means "I don't care"
+GENDER_WILDCARD = "-1"
+
+# special scores
+HAS_MENTOR_IN_MIND = -1
+MENTOR_IS_FULL = -2
+
+#################
+# Question ids  #
+#################
+
+# map each feature to the question_id it comes from on each survey
+MENTOR_QUESTIONS = {
+    "fields_of_study": 17,
+    "field_of_study_preference": 19,
+    "gender": 13,
+    "gender_preference": 20,
+    "availability": 21,
+    "interests": 30,
+    "capacity": 71,
+}
+
+# the likert question_ids on the mentor survey, for each skill a mentee can ask
+# for (on question 55)
+SKILL_QUESTIONS = (
+    23, # Teaching techniques
+    24, # networking
+    25, # tenue review
+    68, # promotion to full profship
+    69, # moving to tenure track
+    70, # become admin
+    26, # research
+    27, # time management
+    28, # work life balance
+    65, # navigating psu
+    66, # faculty of color
+    67, # publication
+)
+
+MENTEE_QUESTIONS = {
+    "fields_of_study": 49,
+    "field_of_study_preference": 51,
+    "gender": 45,
+    "gender_preference": 52,
+    "availability": 53,
+    "skills_wanted": 55,
+    "interests": 57,
+    "has_mentor_in_mind": 61,
+}
+
+# every question the features (and so the scores) are based on
+SCORED_QUESTIONS = frozenset(MENTOR_QUESTIONS.values()) | frozenset(MENTEE_QUESTIONS.values()) | frozenset(SKILL_QUESTIONS)
+
+Features = namedtuple("Features", [
+    "has_mentor_in_mind", # bool (mentee only)
+    "capacity", # max number of mentees (mentor only)
+    "fields_of_study", # bitmask
+    "field_of_study_preference", # bitmask
+    "gender", # code
+    "gender_preference", # code
+    "availability", # int
+    "skills_wanted", # bitmask over SKILL_QUESTIONS (mentee only)
+    "skill_ratings", # tuple of likert ratings in SKILL_QUESTIONS order (mentor only)
+    "interests", # bitmask
+])
+
+def _toInt(value, default=1):
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        return default
+
+class Vocabulary(dict):
+    """Assign each distinct value a small integer code (in the order the values
+    are first seen). The codes double as bit positions for bitmasks"""
+    def code(self, value):
+        try:
+            return self[value]
+        except KeyError:
+            code = self[value] = len(self)
+            return code
+
+    def mask(self, values):
+        mask = 0
+        for value in values:
+            mask |= 1 << self.code(value)
+        return mask
+
+class FeatureEncoder(object):
+    """Encode QuestionDicts into Features. Everything encoded with the same
+    vocabularies can be scored together, since the codes and bit positions are
+    shared. By default, each encoder gets its own in-memory vocabularies"""
+    def __init__(self, fields_of_study=None, interests=None, genders=None):
+        self.fields_of_study = Vocabulary() if fields_of_study is None else fields_of_study
+        self.interests = Vocabulary() if interests is None else interests
+        self.genders = Vocabulary() if genders is None else genders
+        self.skill_bits = dict((q_id, i) for i, q_id in enumerate(SKILL_QUESTIONS))
+
+    def encode(self, q, roles):
+        """Encode the QuestionDict q using roles (MENTOR_QUESTIONS or
+        MENTEE_QUESTIONS) to find the question for each feature"""
+        def value(role):
+            return q[roles[role]].value if role in roles else None
+
+        def values(role):
+            return q[roles[role]].values if role in roles else []
+
+        skills_wanted = 0
+        for q_id in values("skills_wanted"):
+            bit = self.skill_bits.get(_toInt(q_id, None))
+            if bit is not None:
+                skills_wanted |= 1 << bit
+
+        return Features(
+            has_mentor_in_mind=value("has_mentor_in_mind") == "yes",
+            capacity=_toInt(value("capacity")),
+            fields_of_study=self.fields_of_study.mask(values("fields_of_study")),
+            field_of_study_preference=self.fields_of_study.mask(values("field_of_study_preference")),
+            gender=self.genders.code(value("gender")),
+            gender_preference=self.genders.code(value("gender_preference")),
+            availability=_toInt(value("availability")),
+            skills_wanted=skills_wanted,
+            # a missing rating can never be a match
+            skill_ratings=tuple(_toInt(q[q_id].value, 0) for q_id in SKILL_QUESTIONS),
+            interests=self.interests.mask(values("interests")),
+        )
+
+    def encodeMentor(self, q):
+        return self.encode(q, MENTOR_QUESTIONS)
+
+    def encodeMentee(self, q):
+        return self.encode(q, MENTEE_QUESTIONS)
+
+#########
+# Rules #
+#########
+
+# the ways a rule can compare a mentee's feature with a mentor's feature
+OVERLAP = 1 # the bitmasks have a bit in common
+EQUAL = 2 # the codes are the same (a wildcard matches anything, for partial points)
+AT_LEAST = 3 # the mentor's number is at least as high as the mentee's
+LIKERT = 4 # points for each skill the mentee wants that the mentor rates highly
+
+# what kind of value each feature holds. Two features can only be compared if
+# the rule's kind allows their types
+ROLE_TYPES = {
+    "fields_of_study": "field_of_study",
+    "field_of_study_preference": "field_of_study",
+    "interests": "interest",
+    "skills_wanted": "skill",
+    "skill_ratings": "rating",
+    "gender": "gender",
+    "gender_preference": "gender",
+    "availability": "number",
+    "capacity": "number",
+}
+
+# kind -> a function that says if the (mentee type, mentor type) are allowed
+KIND_TYPES = {
+    OVERLAP: lambda mentee, mentor: mentee == mentor and mentee in ("field_of_study", "interest", "skill"),
+    EQUAL: lambda mentee, mentor: mentee == mentor == "gender",
+    AT_LEAST: lambda mentee, mentor: mentee == mentor == "number",
+    LIKERT: lambda mentee, mentor: (mentee, mentor) == ("skill", "rating"),
+}
+
+# the parts of a score a breakdown adds up, and the part each type of feature
+# counts towards
+COMPONENTS = ("field_of_study", "gender", "availability", "skills", "interests")
+TYPE_COMPONENTS = {
+    "field_of_study": 0,
+    "gender": 1,
+    "number": 2,
+    "skill": 3,
+    "rating": 3,
+    "interest": 4,
+}
+# each component gets this many bits of a packed breakdown (so a breakdown
+# fits in a bigint)
+BREAKDOWN_BITS = 12
+BREAKDOWN_MAX = (1 << BREAKDOWN_BITS) - 1
+
+def packBreakdown(parts):
+    """Pack a list of points (one per component) into a single int"""
+    packed = 0
+    for i, points in enumerate(parts):
+        packed |= min(points, BREAKDOWN_MAX) << (i * BREAKDOWN_BITS)
+    return packed
+
+def unpackBreakdown(packed):
+    """Return a list of points (one per component) from a packed breakdown"""
+    return [(packed >> (i * BREAKDOWN_BITS)) & BREAKDOWN_MAX for i in range(len(COMPONENTS))]
+
+# mentee_role and mentor_role name a field on Features. When mutual is set,
+# the comparison has to hold the other way around too (the mentor's
+# mentee_role with the mentee's mentor_role). partial_points and wildcard are
+# only used by EQUAL, and threshold only by LIKERT
+Rule = namedtuple("Rule", "kind mentee_role mentor_role points partial_points threshold mutual wildcard")
+
+# the rules score() uses
+DEFAULT_RULES = (
+    Rule(OVERLAP, "field_of_study_preference", "fields_of_study", MATCHING_FIELD_OF_STUDY_PREFERENCE, 0, 0, True, None),
+    Rule(EQUAL, "gender_preference", "gender", MATCHING_GENDER_PREFERENCE, MATCHING_GENDER_ONE_SIDED, 0, True, GENDER_WILDCARD),
+    Rule(AT_LEAST, "availability", "availability", MATCHING_AVAILABILITY, 0, 0, False, None),
+    Rule(LIKERT, "skills_wanted", "skill_ratings", MATCHING_SKILL, 0, MATCHING_SKILL_LEVEL, False, None),
+    Rule(OVERLAP, "interests", "interests", MATCHING_INTERESTS, 0, 0, False, None),
+)
+
+def checkRule(rule):
+    """Raise a ValueError if the rule can't be compiled"""
+    for role in (rule.mentee_role, rule.mentor_role):
+        if role not in ROLE_TYPES:
+            raise ValueError("%r is not a feature that can be scored" % (role,))
+    if rule.kind not in KIND_TYPES:
+        raise ValueError("%r is not a kind of rule" % (rule.kind,))
+    if not KIND_TYPES[rule.kind](ROLE_TYPES[rule.mentee_role], ROLE_TYPES[rule.mentor_role]):
+        raise ValueError("%s and %s can't be compared that way" % (rule.mentee_role, rule.mentor_role))
+    if rule.points < 0 or rule.partial_points < 0:
+        # negative scores are reserved for HAS_MENTOR_IN_MIND and MENTOR_IS_FULL
+        raise ValueError("Points can't be negative")
+
+class Plan(object):
+    """A list of Rules compiled for scoring lots of pairs. Each rule becomes a
+    step, which is a flat tuple of
+    (kind, mentee index, mentor index, mutual, points, partial points, extra,
+    component) where the indexes point straight into the Features tuples, so scoring a
+    pair doesn't look anything up by name, or create any objects.
+
+    encodeWildcard turns a wildcard value into the code the encoder uses for
+    it (usually the code() method of the gender vocabulary)"""
+    def __init__(self, rules, encodeWildcard):
+        steps = []
+        # columns() tacks a strong skills bitmask onto each mentor for each
+        # LIKERT step
+        self.thresholds = []
+        for rule in rules:
+            checkRule(rule)
+            mentee_index = Features._fields.index(rule.mentee_role)
+            mentor_index = Features._fields.index(rule.mentor_role)
+            mutual = bool(rule.mutual) and rule.kind in (OVERLAP, EQUAL)
+            extra = None
+            if rule.kind == EQUAL:
+                # codes are never negative, so -1 never matches
+                extra = encodeWildcard(rule.wildcard) if rule.wildcard else -1
+            elif rule.kind == LIKERT:
+                mentor_index = len(Features._fields) + len(self.thresholds)
+                self.thresholds.append((Features._fields.index(rule.mentor_role), rule.threshold))
+                # the points for every combination of skills
+                extra = [0]
+                for skill in SKILL_QUESTIONS:
+                    extra += [total + rule.points for total in extra]
+            component = TYPE_COMPONENTS[ROLE_TYPES[rule.mentee_role]]
+            steps.append((rule.kind, mentee_index, mentor_index, mutual, rule.points, rule.partial_points, extra, component))
+        self.steps = tuple(steps)
+
+    def columns(self, mentors, mentee_counts):
+        """Precompute everything about each mentor that score() needs.
+        mentee_counts is the number of mentees each mentor currently has"""
+        columns = []
+        for mentor, count in zip(mentors, mentee_counts):
+            strong = []
+            for index, threshold in self.thresholds:
+                mask = 0
+                for i, rating in enumerate(mentor[index]):
+                    if rating >= threshold:
+                        mask |= 1 << i
+                strong.append(mask)
+            columns.append((count >= mentor.capacity, tuple(mentor) + tuple(strong)))
+        return columns
+
+    def score(self, mentee, column, parts=None):
+        """Score the mentee Features with a mentor (one of the columns from
+        columns()). If parts is a list (with one 0 for each of the
+        COMPONENTS), the points from each step are added to it too"""
+        if mentee.has_mentor_in_mind:
+            return HAS_MENTOR_IN_MIND
+
+        full, mentor = column
+        if full:
+            return MENTOR_IS_FULL
+
+        s = 0
+        for kind, a, b, mutual, points, partial, extra, component in self.steps:
+            gained = 0
+            if kind == OVERLAP:
+                if mentee[a] & mentor[b] and (not mutual or mentor[a] & mentee[b]):
+                    gained = points
+            elif kind == EQUAL:
+                # a is the preference, b is what is preferred
+                if not mutual:
+                    if mentee[a] == mentor[b]:
+                        gained = points
+                    elif mentee[a] == extra:
+                        gained = partial
+                elif mentee[a] == mentor[b] and mentor[a] == mentee[b]:
+                    gained = points
+                elif mentee[a] == mentor[a] == extra:
+                    # neither side cares
+                    pass
+                elif (mentee[a] == mentor[b] and mentor[a] == extra) or (mentor[a] == mentee[b] and mentee[a] == extra):
+                    gained = partial
+            elif kind == AT_LEAST:
+                if mentor[b] >= mentee[a]:
+                    gained = points
+            else:
+                gained = extra[mentee[a] & mentor[b]]
+
+            if gained:
+                s += gained
+                if parts is not None:
+                    parts[component] += gained
+
+        return s
+
+    def bound(self, column, skip=None):
+        """Return the most any mentee could score with this mentor (ignoring
+        the step at index skip)"""
+        mentor = column[1]
+        total = 0
+        for i, (kind, a, b, mutual, points, partial, extra, component) in enumerate(self.steps):
+            if i == skip:
+                continue
+            if kind == OVERLAP:
+                if mentor[b] and (not mutual or mentor[a]):
+                    total += points
+            elif kind == EQUAL:
+                total += max(points, partial)
+            elif kind == AT_LEAST:
+                total += points
+            else:
+                total += extra[mentor[b]]
+        return total
+
+def defaultPlan(encoder):
+    """Return the Plan for DEFAULT_RULES, for Features from this FeatureEncoder"""
+    return Plan(DEFAULT_RULES, encoder.genders.code)
+
+def _scoreRows(mentees, columns, plan, breakdown):
+    """Score each mentee against each column. Returns the rows of scores, and
+    the rows of packed breakdowns (or None, if breakdown is False)"""
+    score = plan.score
+    if not breakdown:
+        return [[score(mentee, column) for column in columns] for mentee in mentees], None
+
+    rows = []
+    breakdowns = []
+    zeros = [0] * len(COMPONENTS)
+    for mentee in mentees:
+        row = []
+        packed = []
+        for column in columns:
+            parts = zeros[:]
+            row.append(score(mentee, column, parts))
+            packed.append(packBreakdown(parts))
+        rows.append(row)
+        breakdowns.append(packed)
+    return rows, breakdowns
+
+def scoreMatrix(mentees, mentors, mentee_counts, plan, breakdown=False):
+    """Score each mentee Features against each mentor Features with the Plan,
+    and return a list of rows (one row per mentee, one column per mentor).
+    mentee_counts is the number of mentees each mentor currently has.
+
+    If breakdown is True, a second matrix is returned too, with the packed
+    breakdown (see packBreakdown()) of each score.
+
+    With DEFAULT_RULES, the scores are identical to what score() returns for
+    the same pair"""
+    # everything that only depends on the mentor is done once, up front
+    columns = plan.columns(mentors, mentee_counts)
+    rows, breakdowns = _scoreRows(mentees, columns, plan, breakdown)
+    if breakdown:
+        return rows, breakdowns
+    return rows
+
+# the mentor columns and Plan each worker process scores with (see
+# _initWorker())
+_worker_state = {}
+
+def _initWorker(columns, plan, breakdown):
+    _worker_state["columns"] = columns
+    _worker_state["plan"] = plan
+    _worker_state["breakdown"] = breakdown
+
+def _scoreBlock(mentees):
+    """Score a block of mentees (as plain tuples) in a worker process"""
+    return _scoreRows(
+        [Features._make(mentee) for mentee in mentees],
+        _worker_state["columns"],
+        _worker_state["plan"],
+        _worker_state["breakdown"]
+    )
+
+def parallelScoreMatrix(mentees, mentors, mentee_counts, plan, processes=1, breakdown=False):
+    """Just like scoreMatrix(), but the rows are split into blocks and scored by
+    a pool of worker processes. The workers are only sent plain tuples: the
+    Plan and mentor columns once (when the worker starts), and then a block of
+    mentees at a time. With one process (or very few mentees) this just calls
+    scoreMatrix()"""
+    if processes <= 1 or len(mentees) < processes:
+        return scoreMatrix(mentees, mentors, mentee_counts, plan, breakdown=breakdown)
+
+    columns = plan.columns(mentors, mentee_counts)
+    # a few blocks per process, so a slow block doesn't hold everyone up
+    block_size = max(1, -(-len(mentees) // (processes * 4)))
+    mentees = [tuple(mentee) for mentee in mentees]
+    blocks = [mentees[i:i+block_size] for i in range(0, len(mentees), block_size)]
+
+    pool = multiprocessing.Pool(processes, initializer=_initWorker, initargs=(columns, plan, breakdown))
+    try:
+        rows = []
+        breakdowns = []
+        for block_rows, block_breakdowns in pool.map(_scoreBlock, blocks):
+            rows.extend(block_rows)
+            if breakdown:
+                breakdowns.extend(block_breakdowns)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if breakdown:
+        return rows, breakdowns
+    return rows
+
+def _bits(mask):
+    """Yield the position of each bit that is set in the mask"""
+    position = 0
+    while mask:
+        if mask & 1:
+            yield position
+        mask >>= 1
+        position += 1
+
+class SuitorIndex(object):
+    """Finds a mentee's top mentors (like Mentee.findSuitors) without scoring
+    every mentor.
+
+    The OVERLAP step in the Plan worth the most points (with the default
+    rules, the field of study) is indexed by the bits in each mentor's
+    bitmasks, so the mentors who get those points can be found directly. Every
+    other step has a ceiling that only depends on the mentor, so each mentor
+    has an upper bound on the score he could get. Mentors are tried in order of
+    that bound, and the search stops as soon as the bound can't beat the k-th
+    best mentor found so far"""
+    def __init__(self, mentors, mentee_counts, plan):
+        self.plan = plan
+        self.columns = plan.columns(mentors, mentee_counts)
+        self.mentee_counts = list(mentee_counts)
+        # how many times a pair was actually scored
+        self.scored = 0
+
+        # the step that gets indexed, if there is one
+        self.indexed = None
+        for i, step in enumerate(plan.steps):
+            kind, a, b, mutual, points = step[:5]
+            if kind == OVERLAP and points > 0 and (self.indexed is None or points > plan.steps[self.indexed][4]):
+                self.indexed = i
+
+        self.mentor_index = defaultdict(list)
+        self.mutual_index = defaultdict(list)
+        self.full = []
+        self.by_bound = []
+        for j, column in enumerate(self.columns):
+            if column[0]:
+                self.full.append(j)
+                continue
+            if self.indexed is not None:
+                kind, a, b, mutual = plan.steps[self.indexed][:4]
+                mentor = column[1]
+                for bit in _bits(mentor[b]):
+                    self.mentor_index[bit].append(j)
+                for bit in _bits(mentor[a]):
+                    self.mutual_index[bit].append(j)
+            # the most this mentor could score without the indexed step
+            self.by_bound.append((plan.bound(column, skip=self.indexed), j))
+        # highest bound first (sort is stable, so ties stay in mentor order)
+        self.by_bound.sort(key=lambda item: -item[0])
+
+    def top(self, mentee, k=3):
+        """Return a list of (column, score) pairs for the k best mentors for
+        this mentee. It's the same list findSuitors() comes up with by scoring
+        every mentor: the highest scores first, and for equal scores, the
+        mentor with fewer mentees first"""
+        # the mentee already has someone in mind
+        if mentee.has_mentor_in_mind or not self.columns:
+            return []
+
+        # the mentors who get the points for the indexed step (with the
+        # default rules: the mentors whose fields of study the mentee prefers,
+        # and who prefer the mentee's fields of study)
+        indexed = set()
+        points = 0
+        if self.indexed is not None:
+            kind, a, b, mutual, points = self.plan.steps[self.indexed][:5]
+            for bit in _bits(mentee[a]):
+                indexed.update(self.mentor_index.get(bit, ()))
+            if mutual:
+                preferred = set()
+                for bit in _bits(mentee[b]):
+                    preferred.update(self.mutual_index.get(bit, ()))
+                indexed &= preferred
+
+        candidates = [
+            [(bound + points, j) for bound, j in self.by_bound if j in indexed],
+            [(bound, j) for bound, j in self.by_bound if j not in indexed],
+        ]
+
+        # a min-heap of (score, -number of mentees, -column), so the worst of
+        # the k best mentors so far is on top
+        best = []
+        for group in candidates:
+            for bound, j in group:
+                if len(best) == k:
+                    worst = best[0]
+                    # nothing else in this group can do better
+                    if bound < worst[0]:
+                        break
+                    if (bound, -self.mentee_counts[j], -j) <= worst:
+                        continue
+
+                self.scored += 1
+                s = self.plan.score(mentee, self.columns[j])
+                item = (s, -self.mentee_counts[j], -j)
+                if len(best) < k:
+                    heapq.heappush(best, item)
+                elif item > best[0]:
+                    heapq.heapreplace(best, item)
+
+        # full mentors are only needed when there aren't enough others
+        for j in self.full:
+            item = (MENTOR_IS_FULL, -self.mentee_counts[j], -j)
+            if len(best) < k:
+                heapq.heappush(best, item)
+            elif item > best[0]:
+                heapq.heapreplace(best, item)
+
+        return [(-j, s) for s, count, j in sorted(best, reverse=True)]
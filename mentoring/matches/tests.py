@@ -4,9 +4,45 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
-
+import json
+import random
+import re
+from datetime import timedelta
+from unittest import skipUnless
+from StringIO import StringIO
+from django.core.exceptions import ValidationError
+from django.template import Context
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.contrib.auth.models import User
+from django.conf.urls import patterns, url
+from django.core import mail
+from django.core.cache import get_cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.dummy import DummyCache
+from django.contrib import messages
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils import timezone
+from mentoring.surveys.models import Survey, Question, Choice, Response, ResponseQuestion, ResponseDocument, ArchivedResponse, ArchivedResponseQuestion
+from .models import QuestionDict, score, ResponseFeatures, ResponseFeaturesManager, StoredVocabulary, vocabulary, featureEncoder, ResponseQuestionCache, Answer
+from .models import SETTINGS_VERSION
+from .models import Mentor, Mentee, Match, MatchScore, Outbox, Settings, ScoringProfile, ScoringRule, scoringPlan, MENTOR_SURVEY_PK, MENTEE_SURVEY_PK
+from .scoring import FeatureEncoder, SuitorIndex, Plan, Rule, scoreMatrix, parallelScoreMatrix, defaultPlan, SKILL_QUESTIONS, DEFAULT_RULES
+from .scoring import OVERLAP, AT_LEAST, COMPONENTS, unpackBreakdown
+from .scoring import MENTOR_QUESTIONS, MENTEE_QUESTIONS, MENTOR_IS_FULL
+from .assignment import optimalAssignment, stableAssignment
+from . import views
 
+# just enough urls to redirect to, for the views that send you back to the
+# match page (the real urlconf needs the CAS app)
+urlpatterns = patterns("",
+    url(r"^manage/match$", views.match, name="manage-match"),
+)
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +50,700 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class Item(object):
+    def __init__(self, value=None, values=()):
+        self.value = value
+        self.values = list(values)
+
+class FakeMentor(object):
+    def __init__(self, number_of_mentees):
+        self.number_of_mentees = number_of_mentees
+
+def randomMentor(rng):
+    fields = ["cs", "math", "art", "music", "law"]
+    q = {
+        17: Item(values=rng.sample(fields, rng.randint(0, 2))),
+        19: Item(values=rng.sample(fields, rng.randint(0, 2))),
+        13: Item(rng.choice(["m", "f"])),
+        20: Item(rng.choice(["m", "f", "-1"])),
+        21: Item(str(rng.randint(1, 4))),
+        30: Item(values=rng.sample(["hiking", "cats", "chess"], rng.randint(0, 2))),
+        71: Item(str(rng.randint(1, 3))),
+    }
+    for q_id in SKILL_QUESTIONS:
+        q[q_id] = Item(str(rng.randint(0, 4)))
+    # sometimes leave a question unanswered
+    del q[rng.choice([17, 19, 13, 20, 21, 30, 71])]
+    return q
+
+def randomMentee(rng):
+    fields = ["cs", "math", "art", "music", "law"]
+    skills = [str(q_id) for q_id in SKILL_QUESTIONS]
+    q = {
+        49: Item(values=rng.sample(fields, rng.randint(0, 2))),
+        51: Item(values=rng.sample(fields, rng.randint(0, 2))),
+        45: Item(rng.choice(["m", "f"])),
+        52: Item(rng.choice(["m", "f", "-1"])),
+        53: Item(str(rng.randint(1, 4))),
+        55: Item(values=rng.sample(skills, rng.randint(0, 4))),
+        57: Item(values=rng.sample(["hiking", "cats", "chess"], rng.randint(0, 2))),
+        61: Item(rng.choice(["yes", "no", "no", "no"])),
+    }
+    del q[rng.choice([49, 51, 45, 52, 53, 57])]
+    return q
+
+class ScoreMatrixTest(TestCase):
+    def test_matches_score(self):
+        """The batch scoring engine gives the same results as score()"""
+        rng = random.Random(42)
+        mentor_qs = [randomMentor(rng) for i in range(30)]
+        mentee_qs = [randomMentee(rng) for i in range(30)]
+        counts = [rng.randint(0, 3) for q in mentor_qs]
+
+        encoder = FeatureEncoder()
+        mentors = [encoder.encodeMentor(QuestionDict(q)) for q in mentor_qs]
+        mentees = [encoder.encodeMentee(QuestionDict(q)) for q in mentee_qs]
+        matrix = scoreMatrix(mentees, mentors, counts, defaultPlan(encoder))
+
+        for i, mentee_q in enumerate(mentee_qs):
+            for j, mentor_q in enumerate(mentor_qs):
+                q = dict(mentee_q)
+                q.update(mentor_q)
+                self.assertEqual(matrix[i][j], score(QuestionDict(q), FakeMentor(counts[j])))
+
+    def test_breakdown(self):
+        """The breakdown adds up to the score"""
+        rng = random.Random(8)
+        encoder = FeatureEncoder()
+        mentors = [encoder.encodeMentor(QuestionDict(randomMentor(rng))) for i in range(20)]
+        mentees = [encoder.encodeMentee(QuestionDict(randomMentee(rng))) for i in range(20)]
+        counts = [rng.randint(0, 3) for mentor in mentors]
+        plan = defaultPlan(encoder)
+        scores, breakdowns = scoreMatrix(mentees, mentors, counts, plan, breakdown=True)
+        self.assertEqual(scores, scoreMatrix(mentees, mentors, counts, plan))
+        for row, packed_row in zip(scores, breakdowns):
+            for s, packed in zip(row, packed_row):
+                parts = unpackBreakdown(packed)
+                self.assertEqual(sum(parts), max(s, 0))
+                self.assertTrue(parts[COMPONENTS.index("field_of_study")] in (0, 10))
+
+    def test_parallel(self):
+        """Scoring with a pool of processes gives the same matrix"""
+        rng = random.Random(3)
+        encoder = FeatureEncoder()
+        mentors = [encoder.encodeMentor(QuestionDict(randomMentor(rng))) for i in range(20)]
+        mentees = [encoder.encodeMentee(QuestionDict(randomMentee(rng))) for i in range(40)]
+        counts = [rng.randint(0, 3) for mentor in mentors]
+        plan = defaultPlan(encoder)
+        self.assertEqual(
+            parallelScoreMatrix(mentees, mentors, counts, plan, processes=2),
+            scoreMatrix(mentees, mentors, counts, plan)
+        )
+        self.assertEqual(
+            parallelScoreMatrix(mentees, mentors, counts, plan, processes=2, breakdown=True),
+            scoreMatrix(mentees, mentors, counts, plan, breakdown=True)
+        )
+
+class ResponseFeaturesTest(TestCase):
+    def test_round_trip(self):
+        """Features survive being saved to, and loaded from the database"""
+        user = User.objects.create_user("mentor", "")
+        survey = Survey.objects.create(name="Mentor")
+        response = Response.objects.create(user=user, survey=survey)
+
+        encoder = featureEncoder()
+        q = randomMentor(random.Random(1))
+        # make sure there is a bit way past what a bigint could hold
+        q[17] = Item(values=["field %d" % i for i in range(100)])
+        features = encoder.encodeMentor(QuestionDict(q))
+        ResponseFeatures.fromFeatures(response.pk, features).save()
+
+        self.assertEqual(ResponseFeatures.objects.features([response.pk]), {response.pk: features})
+
+    def test_vocabulary_codes_are_stored(self):
+        vocab = vocabulary("test")
+        code = vocab.code("a")
+        self.assertEqual(vocab.code("a"), code)
+        self.assertNotEqual(vocab.code("b"), code)
+        self.assertEqual(StoredVocabulary("test"), vocab)
+        self.assertEqual(vocab.code(None), 0)
+
+class ResponseQuestionCacheTest(TestCase):
+    def test_least_recently_used_is_evicted(self):
+        cache = ResponseQuestionCache(max_size=2)
+        # pretend the cache was already loaded from the database
+        cache.primed = True
+        cache._put(1, {17: Answer("cs", ("cs",))})
+        cache._put(2, {})
+        # response 1 was used more recently than response 2
+        self.assertEqual(cache.get(1), {17: Answer("cs", ("cs",))})
+        cache._put(3, {})
+        self.assertEqual(list(cache.entries), [1, 3])
+
+        cache.invalidate(1)
+        self.assertEqual(list(cache.entries), [3])
+
+class OptimalAssignmentTest(TestCase):
+    def test_beats_greedy(self):
+        # greedily giving mentee 0 his favorite mentor leaves mentee 1 with
+        # nobody
+        scores = [
+            [10, 8],
+            [10, -1],
+        ]
+        self.assertEqual(optimalAssignment(scores, [1, 1]), [1, 0])
+
+    def test_capacity(self):
+        scores = [
+            [5, 1],
+            [5, 1],
+            [5, 1],
+        ]
+        assignment = optimalAssignment(scores, [2, 0])
+        self.assertEqual(sorted(assignment), [None, 0, 0])
+
+    def test_forbidden_pairs(self):
+        self.assertEqual(optimalAssignment([[-1, -2]], [1, 1]), [None])
+
+class StableAssignmentTest(TestCase):
+    def test_is_stable(self):
+        rng = random.Random(7)
+        for trial in range(50):
+            scores = [[rng.choice([-1, -2, 0, 3, 5, 10, 13]) for j in range(6)] for i in range(10)]
+            capacities = [rng.randint(0, 2) for j in range(6)]
+            assignment = stableAssignment(scores, capacities)
+
+            held = [[i for i, column in enumerate(assignment) if column == j] for j in range(6)]
+            for j, rows in enumerate(held):
+                self.assertTrue(len(rows) <= capacities[j])
+            # look for a mentee and mentor who would both rather be together
+            for i, row in enumerate(scores):
+                for j, s in enumerate(row):
+                    if s < 0 or capacities[j] == 0 or assignment[i] == j:
+                        continue
+                    mentee_prefers = assignment[i] is None or (-s, j) < (-row[assignment[i]], assignment[i])
+                    mentor_prefers = len(held[j]) < capacities[j] or any((-s, i) < (-scores[k][j], k) for k in held[j])
+                    self.assertFalse(mentee_prefers and mentor_prefers)
+
+class SuitorIndexTest(TestCase):
+    def exhaustive(self, mentee, mentors, counts, plan):
+        """The top 3 the way findSuitors used to find them"""
+        scores = scoreMatrix([mentee], mentors, counts, plan)[0]
+        suitors = []
+        for j, s in enumerate(scores):
+            if s == -1:
+                break
+            suitors.append((j, s))
+        suitors.sort(key=lambda pair: (-pair[1], counts[pair[0]]))
+        return suitors[0:3]
+
+    def test_same_as_exhaustive(self):
+        rng = random.Random(11)
+        encoder = FeatureEncoder()
+        mentors = [encoder.encodeMentor(QuestionDict(randomMentor(rng))) for i in range(200)]
+        mentees = [encoder.encodeMentee(QuestionDict(randomMentee(rng))) for i in range(50)]
+        counts = [rng.randint(0, 3) for mentor in mentors]
+        plan = defaultPlan(encoder)
+
+        index = SuitorIndex(mentors, counts, plan)
+        for mentee in mentees:
+            self.assertEqual(index.top(mentee, 3), self.exhaustive(mentee, mentors, counts, plan))
+        # it shouldn't need to score every pair
+        self.assertTrue(index.scored < len(mentors) * len(mentees) / 2)
+
+    def test_other_rules(self):
+        rng = random.Random(12)
+        encoder = FeatureEncoder()
+        mentors = [encoder.encodeMentor(QuestionDict(randomMentor(rng))) for i in range(100)]
+        mentees = [encoder.encodeMentee(QuestionDict(randomMentee(rng))) for i in range(30)]
+        counts = [rng.randint(0, 3) for mentor in mentors]
+        plan = Plan([
+            Rule(OVERLAP, "interests", "interests", 4, 0, 0, False, None),
+            Rule(AT_LEAST, "availability", "availability", 1, 0, 0, False, None),
+        ], encoder.genders.code)
+
+        index = SuitorIndex(mentors, counts, plan)
+        for mentee in mentees:
+            self.assertEqual(index.top(mentee, 3), self.exhaustive(mentee, mentors, counts, plan))
+
+class RacingFeaturesManager(ResponseFeaturesManager):
+    """Doesn't see the stored features the first time it looks, like when
+    another request compiles them in the meantime"""
+    raced = False
+
+    def filter(self, *args, **kwargs):
+        if not self.raced:
+            self.raced = True
+            return super(RacingFeaturesManager, self).filter(pk__in=[])
+        return super(RacingFeaturesManager, self).filter(*args, **kwargs)
+
+    def encode(self, responses):
+        # the answers are read with MySQL only SQL, so "compile" them from the
+        # stored features instead
+        stored = ResponseFeatures.objects.filter(pk__in=[response.pk for response in responses])
+        return dict((rf.pk, rf.toFeatures()) for rf in stored)
+
+class MatchScoreTest(TestCase):
+    def setUp(self):
+        rng = random.Random(5)
+        encoder = featureEncoder()
+        mentor_survey = Survey.objects.create(pk=MENTOR_SURVEY_PK, name="Mentor")
+        mentee_survey = Survey.objects.create(pk=MENTEE_SURVEY_PK, name="Mentee")
+
+        def person(model, survey, username, q):
+            user = User.objects.create_user(username, "")
+            response = Response.objects.create(user=user, survey=survey)
+            features = encoder.encode(QuestionDict(q), MENTOR_QUESTIONS if model is Mentor else MENTEE_QUESTIONS)
+            ResponseFeatures.fromFeatures(response.pk, features).save()
+            return model.objects.create(user=user, response=response)
+
+        mentor_q = randomMentor(rng)
+        mentor_q[71] = Item("1")
+        self.mentor = person(Mentor, mentor_survey, "mentor", mentor_q)
+        self.mentees = []
+        for i in range(3):
+            mentee_q = randomMentee(rng)
+            mentee_q[61] = Item("no")
+            self.mentees.append(person(Mentee, mentee_survey, "mentee%d" % i, mentee_q))
+
+    def scores(self):
+        return sorted(MatchScore.objects.filter(mentor=self.mentor).values_list("mentee_id", "score"))
+
+    def test_refresh_mentor(self):
+        MatchScore.objects.refreshMentor(self.mentor.pk)
+        self.mentor.number_of_mentees = 0
+        expected = sorted((mentee.pk, mentee.scoreWith(self.mentor)) for mentee in self.mentees)
+        self.assertEqual(self.scores(), expected)
+        for match_score in MatchScore.objects.filter(mentor=self.mentor):
+            self.assertEqual(sum(match_score.parts().values()), max(match_score.score, 0))
+
+    def test_without_breakdowns(self):
+        MatchScore.objects.refreshMentor(self.mentor.pk)
+        expected = self.scores()
+        with override_settings(MATCH_SCORE_BREAKDOWN=False):
+            MatchScore.objects.refreshMentor(self.mentor.pk)
+            MatchScore.objects.filter(mentee=self.mentees[1]).delete()
+            MatchScore.objects.tile(self.mentees, [self.mentor])
+        self.assertEqual(self.scores(), expected)
+        self.assertEqual(set(MatchScore.objects.values_list("breakdown", flat=True)), set([None]))
+
+    def test_grid_tile(self):
+        request = RequestFactory().get("/matches/grid", {"row": 1, "rows": 2})
+        request.user = User.objects.create_user("staff", "")
+        request.user.is_staff = True
+        response = views.grid(request)
+        data = json.loads(response.content)
+        self.assertEqual(data["total_rows"], 3)
+        self.assertEqual([mentee[0] for mentee in data["mentees"]], [mentee.pk for mentee in self.mentees[1:3]])
+        self.mentor.number_of_mentees = 0
+        self.assertEqual(data["scores"], [[mentee.scoreWith(self.mentor)] for mentee in self.mentees[1:3]])
+
+        # nothing changed, so the tile isn't sent again
+        request.META["HTTP_IF_NONE_MATCH"] = response["ETag"]
+        self.assertEqual(views.grid(request).status_code, 304)
+        Match.objects.engage(self.mentor.pk, self.mentees[0].pk)
+        self.assertEqual(views.grid(request).status_code, 200)
+
+    def test_tile_in_processes(self):
+        self.mentor.number_of_mentees = 0
+        expected = [[mentee.scoreWith(self.mentor)] for mentee in self.mentees]
+        MatchScore.objects.all().delete()
+        with override_settings(MATCH_SCORING_PROCESSES=2):
+            self.assertEqual(MatchScore.objects.tile(self.mentees, [self.mentor]), expected)
+        self.assertEqual(sorted(MatchScore.objects.values_list("score", flat=True)), sorted(row[0] for row in expected))
+
+    def test_full_mentor(self):
+        MatchScore.objects.refreshMentor(self.mentor.pk)
+        # the mentor only wants one mentee
+        Match.objects.engage(self.mentor.pk, self.mentees[0].pk)
+        self.assertEqual([s for mentee_id, s in self.scores()], [MENTOR_IS_FULL] * 3)
+        Match.objects.breakup(self.mentor.pk, self.mentees[0].pk)
+        self.assertTrue(all(s >= 0 for mentee_id, s in self.scores()))
+
+    def test_engage_removed_mentee(self):
+        Mentee.objects.filter(pk=self.mentees[0].pk).update(is_deleted=True)
+        self.assertFalse(Match.objects.engage(self.mentor.pk, self.mentees[0].pk))
+        results = Match.objects.apply([(self.mentor.pk, self.mentees[0].pk, "engage")])
+        self.assertEqual([applied for mentor_id, mentee_id, action, applied in results], [False])
+        self.assertFalse(Match.objects.exists())
+
+    def test_features_compiled_by_another_request(self):
+        manager = RacingFeaturesManager()
+        manager.model = ResponseFeatures
+        response_id = self.mentor.response_id
+        features = manager.features([response_id])
+        self.assertEqual(features[response_id], ResponseFeatures.objects.get(pk=response_id).toFeatures())
+        self.assertEqual(ResponseFeatures.objects.filter(pk=response_id).count(), 1)
+
+    def test_delete_engaged_mentee(self):
+        Match.objects.engage(self.mentor.pk, self.mentees[0].pk)
+        self.assertEqual([s for mentee_id, s in self.scores()], [MENTOR_IS_FULL] * 3)
+        # the mentor has room again, so the other mentees are rescored
+        self.mentees[0].delete()
+        self.mentor.number_of_mentees = 0
+        expected = sorted((mentee.pk, mentee.scoreWith(self.mentor)) for mentee in self.mentees[1:])
+        self.assertEqual(self.scores(), expected)
+        self.assertTrue(all(s >= 0 for mentee_id, s in self.scores()))
+
+    def test_transitions(self):
+        mentor_id, mentee_id = self.mentor.pk, self.mentees[0].pk
+        # the mentor only has room for one mentee, and a pair can only be
+        # engaged once
+        self.assertTrue(Match.objects.engage(mentor_id, mentee_id))
+        self.assertFalse(Match.objects.engage(mentor_id, mentee_id))
+        self.assertFalse(Match.objects.engage(mentor_id, self.mentees[1].pk))
+        self.assertEqual(Match.objects.filter(mentor_id=mentor_id).count(), 1)
+
+        # each transition only happens from the right state
+        self.assertFalse(Match.objects.divorce(mentor_id, mentee_id))
+        self.assertFalse(Match.objects.complete(mentor_id, mentee_id))
+        self.assertTrue(Match.objects.marry(mentor_id, mentee_id))
+        self.assertFalse(Match.objects.marry(mentor_id, mentee_id))
+        self.assertFalse(Match.objects.breakup(mentor_id, mentee_id))
+        self.assertTrue(Match.objects.complete(mentor_id, mentee_id))
+        self.assertFalse(Match.objects.complete(mentor_id, mentee_id))
+        self.assertFalse(Match.objects.divorce(mentor_id, mentee_id))
+
+        # once it's completed, the mentor has room, and the pair can be
+        # matched again
+        self.assertTrue(Match.objects.engage(mentor_id, mentee_id))
+        self.assertTrue(Match.objects.breakup(mentor_id, mentee_id))
+        self.assertEqual(Match.objects.filter(mentor_id=mentor_id).count(), 1)
+
+    def test_bulk(self):
+        Settings.objects.create(send_email=True, mentor_subject="Mentor", mentee_subject="Mentee")
+        mentor_id = self.mentor.pk
+        request = RequestFactory().post("/matches/bulk", {"pair": [
+            "engage:%d:%d" % (mentor_id, self.mentees[0].pk),
+            # the mentor only has room for one
+            "engage:%d:%d" % (mentor_id, self.mentees[1].pk),
+            "marry:%d:%d" % (mentor_id, self.mentees[0].pk),
+            "marry:%d:%d" % (mentor_id, self.mentees[1].pk),
+        ]}, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        request.user = User.objects.create_user("staff", "")
+        request.user.is_staff = True
+        results = json.loads(views.bulk(request).content)
+        self.assertEqual([result["applied"] for result in results], [True, False, True, False])
+        self.assertEqual(list(Match.objects.filter(married_on__isnull=False).values_list("mentee_id", flat=True)), [self.mentees[0].pk])
+        # both of them are emailed, in one batch
+        self.assertEqual(sorted(Outbox.objects.values_list("subject", flat=True)), ["Mentee", "Mentor"])
+        self.assertEqual([s for mentee_id, s in self.scores()], [MENTOR_IS_FULL] * 3)
+
+        results = Match.objects.apply([(mentor_id, self.mentees[0].pk, "complete"), (mentor_id, self.mentees[0].pk, "divorce")])
+        self.assertEqual([applied for mentor_id, mentee_id, action, applied in results], [True, False])
+        self.assertRaises(ValueError, Match.objects.apply, [(mentor_id, self.mentees[0].pk, "elope")])
+
+    @override_settings(ROOT_URLCONF="mentoring.matches.tests")
+    def test_accept_bad_pair(self):
+        request = RequestFactory().post("/matches/accept", {"pair": ["%d:%d" % (self.mentor.pk, self.mentees[0].pk), "%d" % self.mentor.pk]})
+        request.user = User.objects.create_user("staff", "")
+        request.user.is_staff = True
+        request.session = {}
+        request._messages = FallbackStorage(request)
+        self.assertEqual(views.accept(request).status_code, 302)
+        self.assertEqual([m.level for m in request._messages], [messages.ERROR])
+        self.assertFalse(Match.objects.exists())
+
+class ScoringProfileTest(TestCase):
+    def test_version_bumps_are_not_lost(self):
+        profile = ScoringProfile.objects.create(name="Interests")
+        self.assertEqual(profile.version, 1)
+        # a rule changes while the profile is being edited somewhere else
+        ScoringProfile.objects.get(pk=profile.pk).touch()
+        profile.name = "Hobbies"
+        profile.save()
+        self.assertEqual(profile.version, 3)
+        self.assertEqual(ScoringProfile.objects.get(pk=profile.pk).version, 3)
+
+    def test_default(self):
+        self.assertEqual(scoringPlan().steps, Plan(DEFAULT_RULES, vocabulary("gender").code).steps)
+
+    def test_profile_is_compiled_when_it_changes(self):
+        profile = ScoringProfile.objects.create(name="Interests", is_active=True)
+        rule = ScoringRule.objects.create(profile=profile, kind=OVERLAP, mentee_role="interests", mentor_role="interests", points=7)
+        plan = scoringPlan()
+        self.assertEqual([step[4] for step in plan.steps], [7])
+        # nothing changed, so the same plan is used
+        self.assertTrue(scoringPlan() is plan)
+
+        rule.points = 2
+        rule.save()
+        self.assertEqual([step[4] for step in scoringPlan().steps], [2])
+
+        profile.is_active = False
+        profile.save()
+        self.assertEqual(len(scoringPlan().steps), len(DEFAULT_RULES))
+
+    def test_bad_rule(self):
+        profile = ScoringProfile.objects.create(name="Bad")
+        rule = ScoringRule(profile=profile, kind=AT_LEAST, mentee_role="interests", mentor_role="gender", points=1)
+        self.assertRaises(ValidationError, rule.clean)
+
+class ArchiveResponsesTest(TestCase):
+    def test_archive(self):
+        survey = Survey.objects.create(pk=MENTOR_SURVEY_PK, name="Mentor")
+        question = Question.objects.create(survey=survey, type=Question.RADIO, rank=0, layout=Question.NORMAL)
+        choice = Choice.objects.create(question=question, body="Yes", value="yes", rank=0)
+        long_ago = timezone.now() - timedelta(days=100)
+
+        def response(user, is_latest, created_on):
+            response = Response.objects.create(user=user, survey=survey, is_latest=is_latest)
+            Response.objects.filter(pk=response.pk).update(created_on=created_on)
+            ResponseQuestion.objects.create(response=response, question=question, choice=choice, value="yes")
+            return response
+
+        mentor_user = User.objects.create_user("mentor", "")
+        superseded = response(mentor_user, None, long_ago)
+        recent = response(mentor_user, None, timezone.now())
+        latest = response(mentor_user, True, timezone.now())
+        Mentor.objects.create(user=mentor_user, response=latest)
+        # superseded, but a mentee still points at it
+        mentee_user = User.objects.create_user("mentee", "")
+        pointed_at = response(mentee_user, None, long_ago)
+        Mentee.objects.create(user=mentee_user, response=pointed_at)
+        # and so does a mentor who was removed
+        removed_user = User.objects.create_user("removed", "")
+        removed_at = response(removed_user, None, long_ago)
+        Mentor.objects.create(user=removed_user, response=removed_at, is_deleted=True)
+
+        out = StringIO()
+        call_command("archiveresponses", days=30, batch_size=1, pause=0, stdout=out)
+        self.assertTrue("Archived 1 responses and 1 response_question rows" in out.getvalue())
+        self.assertEqual(sorted(Response.objects.values_list("pk", flat=True)), sorted([recent.pk, latest.pk, pointed_at.pk, removed_at.pk]))
+        self.assertEqual(list(ArchivedResponse.objects.values_list("pk", flat=True)), [superseded.pk])
+        self.assertEqual(list(ArchivedResponseQuestion.objects.values_list("response_id", flat=True)), [superseded.pk])
+        self.assertFalse(ResponseQuestion.objects.filter(response_id=superseded.pk).exists())
+
+class GenerateCohortTest(TestCase):
+    def test_generate(self):
+        mentor_survey = Survey.objects.create(pk=MENTOR_SURVEY_PK, name="Mentor")
+        mentee_survey = Survey.objects.create(pk=MENTEE_SURVEY_PK, name="Mentee")
+        for survey, q_ids in ((mentor_survey, (17, 19)), (mentee_survey, (49, 51))):
+            for rank, q_id in enumerate(q_ids):
+                Question.objects.create(pk=q_id, survey=survey, type=Question.SELECT_MULTIPLE, rank=rank, layout=Question.NORMAL)
+        question = Question.objects.create(pk=61, survey=mentee_survey, type=Question.RADIO, rank=5, layout=Question.NORMAL)
+        for rank, value in enumerate(["yes", "no"]):
+            Choice.objects.create(question=question, body=value, value=value, rank=rank)
+
+        call_command("generatecohort", size=7, stdout=StringIO())
+        self.assertEqual(Mentor.objects.count(), 7)
+        self.assertEqual(Mentee.objects.count(), 7)
+        # the fields of study taxonomy was added, and only the fields of study
+        # (not the colleges) were picked
+        answers = ResponseQuestion.objects.filter(question_id=17)
+        self.assertTrue(Choice.objects.filter(question_id=17).count() > 50)
+        self.assertTrue(answers.count() >= 7)
+        self.assertFalse(any(answer.value.startswith("[") for answer in answers))
+
+        call_command("generatecohort", size=7, clear=True, stdout=StringIO())
+        self.assertEqual(Mentor.objects.count(), 7)
+
+class FailingBackend(BaseEmailBackend):
+    def send_messages(self, messages):
+        raise IOError("The mail server is down")
+
+class FlakyBackend(locmem.EmailBackend):
+    """Can't send the emails whose subject is "Flaky", but sends the rest"""
+    def send_messages(self, messages):
+        if any(message.subject == "Flaky" for message in messages):
+            raise IOError("The mail server hung up")
+        return super(FlakyBackend, self).send_messages(messages)
+
+class OutboxTest(TestCase):
+    def test_deliver(self):
+        for i in range(3):
+            Outbox.objects.enqueue("Subject %d" % i, "Body", "no-reply@pdx.edu", ["a@pdx.edu", "b@pdx.edu"])
+        call_command("sendoutbox", batch_size=2)
+        self.assertEqual([m.subject for m in mail.outbox], ["Subject 0", "Subject 1", "Subject 2"])
+        self.assertEqual(mail.outbox[0].to, ["a@pdx.edu", "b@pdx.edu"])
+        # nothing is sent twice
+        self.assertEqual(Outbox.objects.deliver(), 0)
+
+    @override_settings(EMAIL_BACKEND="mentoring.matches.tests.FlakyBackend")
+    def test_failure_in_full_batch(self):
+        for subject in ["Subject 0", "Flaky", "Subject 2", "Subject 3"]:
+            Outbox.objects.enqueue(subject, "Body", "no-reply@pdx.edu", ["a@pdx.edu"])
+        # the failure doesn't stop the rest of the outbox from being sent
+        call_command("sendoutbox", batch_size=2)
+        self.assertEqual([m.subject for m in mail.outbox], ["Subject 0", "Subject 2", "Subject 3"])
+        self.assertEqual(Outbox.objects.get(sent_on__isnull=True).subject, "Flaky")
+
+    @override_settings(EMAIL_BACKEND="mentoring.matches.tests.FailingBackend")
+    def test_retry(self):
+        Outbox.objects.enqueue("Subject", "Body", "no-reply@pdx.edu", ["a@pdx.edu"])
+        # it was tried, but not sent
+        self.assertEqual(Outbox.objects.deliver(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+        message = Outbox.objects.get()
+        self.assertEqual(message.attempts, 1)
+        self.assertTrue("mail server is down" in message.last_error)
+        # it isn't due again until later
+        self.assertEqual(Outbox.objects.deliver(), 0)
+        self.assertEqual(Outbox.objects.get().attempts, 1)
+
+class SettingsCacheTest(TestCase):
+    def test_cached(self):
+        settings = Settings.objects.default()
+        settings.mentor_body = "Hi {{ mentor_name }}"
+        settings.save()
+        cached = Settings.objects.cached()
+        self.assertEqual(cached.mentor_template.render(Context({"mentor_name": "Al"})), "Hi Al")
+        # only the version token is read (from the shared cache's table)
+        with self.assertNumQueries(1):
+            self.assertTrue(Settings.objects.cached() is cached)
+
+        settings.mentor_body = "Hello {{ mentor_name }}"
+        settings.save()
+        self.assertEqual(Settings.objects.cached().mentor_template.render(Context({"mentor_name": "Al"})), "Hello Al")
+
+    def test_token_is_read_once_per_request(self):
+        Settings.objects.default()
+        SETTINGS_VERSION.requestStarted()
+        try:
+            # the token, and the Settings
+            with self.assertNumQueries(2):
+                cached = Settings.objects.cached()
+            # like when each match in Match.objects.apply() is notified
+            with self.assertNumQueries(0):
+                for i in range(3):
+                    self.assertTrue(Settings.objects.cached() is cached)
+            # a change made during the request is seen right away
+            settings = Settings.objects.default()
+            settings.mentor_body = "Hello"
+            settings.save()
+            self.assertEqual(Settings.objects.cached().mentor_body, "Hello")
+        finally:
+            SETTINGS_VERSION.requestFinished()
+        # the next request (or anything outside of one) reads it again
+        with self.assertNumQueries(1):
+            Settings.objects.cached()
+
+    def test_cache_is_shared(self):
+        # the version tokens only reach the other processes through a cache
+        # they share
+        self.assertFalse(isinstance(get_cache("default"), (LocMemCache, DummyCache)))
+
+# the queries written in MySQL's dialect can only be explained there
+mysqlOnly = skipUnless(connection.vendor == "mysql", "the query is MySQL only")
+
+class QueryPlanTest(TestCase):
+    """EXPLAIN the raw queries that join the big tables, and make sure none of
+    them read a whole table they shouldn't. This runs on MySQL and sqlite
+    (with EXPLAIN QUERY PLAN)"""
+    def setUp(self):
+        mentor_survey = Survey.objects.create(pk=MENTOR_SURVEY_PK, name="Mentor")
+        mentee_survey = Survey.objects.create(pk=MENTEE_SURVEY_PK, name="Mentee")
+        questions = []
+        for survey in (mentor_survey, mentee_survey):
+            for rank in range(5):
+                question = Question.objects.create(survey=survey, type=Question.RADIO, rank=rank, layout=Question.NORMAL)
+                choice = Choice.objects.create(question=question, body="Yes", value="yes", rank=0)
+                questions.append((survey, question, choice))
+
+        size = 300
+        User.objects.bulk_create([User(username="user%d" % i) for i in range(size * 2)])
+        users = list(User.objects.order_by("pk"))
+        Response.objects.bulk_create(
+            [Response(user=user, survey=mentor_survey, is_latest=True) for user in users[:size]] +
+            [Response(user=user, survey=mentee_survey, is_latest=True) for user in users[size:]]
+        )
+        responses = list(Response.objects.order_by("pk"))
+        # every response but the last has its document, so Survey.report()
+        # looks for the missing ones, and then joins the rest
+        ResponseDocument.objects.bulk_create([ResponseDocument(response=response, document="[]") for response in responses[:-1]])
+        ResponseQuestion.objects.bulk_create([
+            ResponseQuestion(response=response, question=question, choice=choice, value=choice.value)
+            for response in responses
+            for survey, question, choice in questions
+            if survey.pk == response.survey_id
+        ])
+        Mentor.objects.bulk_create([Mentor(user=r.user, response=r) for r in responses[:size]])
+        Mentee.objects.bulk_create([Mentee(user=r.user, response=r) for r in responses[size:]])
+        mentors = list(Mentor.objects.order_by("pk"))
+        mentees = list(Mentee.objects.order_by("pk"))
+        Match.objects.bulk_create([Match(mentor=mentors[i], mentee=mentees[i]) for i in range(0, size, 2)])
+
+        cursor = connection.cursor()
+        for table in ("mentor", "mentee", "`match`", "response", "response_question", "response_document", "question", "choice"):
+            if connection.vendor == "mysql":
+                cursor.execute("ANALYZE TABLE " + table)
+                cursor.fetchall()
+            else:
+                cursor.execute("ANALYZE " + table)
+
+    def assertNoFullScans(self, run, scanned=()):
+        """Run the function, and EXPLAIN each SELECT it ran. Fail if a table,
+        other than the ones in scanned, is read with a full table scan"""
+        # keep the SQL and params of each query, since what sqlite logs
+        # can't be run again
+        queries = []
+        last_executed_query = connection.ops.last_executed_query
+        def record(cursor, sql, params):
+            queries.append((sql, params))
+            return last_executed_query(cursor, sql, params)
+        connection.ops.last_executed_query = record
+        try:
+            with CaptureQueriesContext(connection):
+                run()
+        finally:
+            del connection.ops.last_executed_query
+        self.assertTrue(len(queries) > 0)
+
+        cursor = connection.cursor()
+        for sql, params in queries:
+            if not sql.lstrip().upper().startswith("SELECT"):
+                continue
+            for table in self.scannedTables(cursor, sql, params):
+                if table not in scanned:
+                    self.fail("Full table scan of %s in:\n%s" % (table, sql))
+
+    def scannedTables(self, cursor, sql, params):
+        """Return the tables the query reads with a full table scan"""
+        if connection.vendor == "mysql":
+            cursor.execute("EXPLAIN " + sql, params)
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            # derived tables (subqueries in the FROM clause) don't have indexes
+            return [row["table"] for row in rows if row["type"] == "ALL" and not (row["table"] or "").startswith("<")]
+
+        # sqlite says "SCAN <table>" (or "SCAN TABLE <table>" in older
+        # versions), and "USING ... INDEX" when it only reads an index
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        scans = [re.match(r"SCAN (?:TABLE )?(\S+)(.*)", row[-1]) for row in cursor.fetchall()]
+        return [scan.group(1) for scan in scans if scan and "INDEX" not in scan.group(2)]
+
+    @mysqlOnly
+    def test_with_mentee_count(self):
+        self.assertNoFullScans(lambda: list(Mentor.objects.withMenteeCount()), scanned=["mentor"])
+
+    @mysqlOnly
+    def test_get_responses(self):
+        self.assertNoFullScans(lambda: list(Mentor.objects.getResponses()), scanned=["mentor"])
+
+    @mysqlOnly
+    def test_unmatched(self):
+        self.assertNoFullScans(lambda: list(Mentee.objects.unmatched()), scanned=["mentee"])
+
+    @mysqlOnly
+    def test_by_mentor(self):
+        self.assertNoFullScans(lambda: Match.objects.byMentor(married=False), scanned=["match"])
+
+    def test_survey_report(self):
+        survey = Survey.objects.get(pk=MENTEE_SURVEY_PK)
+        # the question table is small, and each survey is a big part of it, so
+        # reading all of it (to compile the missing document) is fine
+        self.assertNoFullScans(lambda: list(survey.report()), scanned=["question"])
+        # once every document is compiled, it is one query to find the
+        # missing ones, and one for the rows, however many responses there are
+        with self.assertNumQueries(2):
+            self.assertEqual(len(list(survey.report())), 300)
+
+    def test_response_report(self):
+        response = Response.objects.filter(survey_id=MENTEE_SURVEY_PK)[0]
+        self.assertNoFullScans(lambda: response.report())
+
+    def test_build_report(self):
+        response = Response.objects.filter(survey_id=MENTEE_SURVEY_PK)[0]
+        self.assertNoFullScans(lambda: response.buildReport(), scanned=["question"])
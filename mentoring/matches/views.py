@@ -1,62 +1,127 @@
+import hashlib
+import json
 from ordereddict import OrderedDict 
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest, Http404
 from django.shortcuts import render
 from django.core.urlresolvers import reverse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 from django.contrib import messages
 from mentoring.surveys.models import Survey, Question, Response
 from mentoring.surveys.forms import SurveyForm
 from mentoring.matches.decorators import staff_member_required
 from mentoring.utils import UnicodeWriter
-from .models import buildResponseQuestionLookupTable, score, Mentee, Mentor, Match, Settings
+from .models import proposeAssignment, suitorIndex, Mentee, Mentor, Match, MatchScore, Settings, ResponseFeatures
 from .forms import SettingsForm
+from .assignment import optimalAssignment, stableAssignment
 
 @staff_member_required
 def manage(request):
     return render(request, 'manage/manage.html', {
     })
 
+# the size of the tiles the score grid is loaded in (see grid())
+TILE_ROWS = 50
+TILE_COLUMNS = 20
+MAX_TILE_SIZE = 200
+
 @staff_member_required
 def match(request):
-    mentor_responses = list(Mentor.objects.getResponses())
-    mentee_responses = list(Mentee.objects.getRespones())
-
-    results = []
-    # for each mentor, mentee pair, score them together
-    for mentee_response in mentee_responses:
-        results.append([])
-        for mentor_response in mentor_responses:
-            q = buildResponseQuestionLookupTable(mentee_response, mentor_response)
-            s = score(q, mentor_response)
-
-            results[-1].append({
-                "mentor_response": mentor_response,
-                "mentee_response": mentee_response,
-                "score": s
-            })
+    # the score grid isn't rendered here. The page loads it a tile at a time
+    # (see grid())
 
     # find the best suitors for each unmatched mentee
     unmatched_mentees = list(Mentee.objects.unmatched())
     suitors = list(Mentor.objects.withMenteeCount())
+    ResponseFeatures.objects.attach(unmatched_mentees + suitors)
+    index = suitorIndex(suitors)
     for mentee in unmatched_mentees:
-        mentee.suitors = mentee.findSuitors(suitors)
+        mentee.suitors = mentee.findSuitors(suitors, index=index)
+
+    # pair up all the unmatched mentees at once, if asked to
+    assignment = request.GET.get("assignment", "")
+    proposals = []
+    if assignment == "optimal":
+        proposals = proposeAssignment(unmatched_mentees, suitors, solver=optimalAssignment)
+    elif assignment == "stable":
+        proposals = proposeAssignment(unmatched_mentees, suitors, solver=stableAssignment)
 
     engagements = Match.objects.byMentor(married=False)
     marriages = Match.objects.byMentor(married=True)
 
-    if Settings.objects.default().send_email:
+    if Settings.objects.cached().send_email:
         messages.warning(request, 'Email notifications are turned on!')
 
     mentors = list(Mentor.objects.all().select_related("user").order_by("user__last_name", "user__first_name"))
     return render(request, "manage/matches.html", {
-        "results": results,
-        "mentee_responses": mentee_responses,
-        "mentor_responses": mentor_responses,
+        "tile_rows": TILE_ROWS,
+        "tile_columns": TILE_COLUMNS,
         "unmatched_mentees": unmatched_mentees,
         "engagements": engagements,
         "marriages": marriages,
         "mentors": mentors,
+        "assignment": assignment,
+        "proposals": proposals,
     })
 
+def _gridETag(request):
+    return hashlib.md5(MatchScore.objects.version() + "?" + request.GET.urlencode()).hexdigest()
+
+def _tileParameter(request, name, default):
+    try:
+        return max(0, int(request.GET.get(name, default)))
+    except ValueError:
+        return default
+
+@staff_member_required
+@condition(etag_func=_gridETag)
+def grid(request):
+    """Return one tile of the score grid as JSON. The row and col parameters
+    are where the tile starts (counting from 0), and rows and cols are how
+    big it is. Mentees are the rows, and mentors are the columns, both
+    ordered by id. The scores are a list of rows, with one score per mentor.
+    Nothing is sent (just a 304) if nothing changed since the browser last
+    loaded the tile"""
+    row = _tileParameter(request, "row", 0)
+    col = _tileParameter(request, "col", 0)
+    rows = min(MAX_TILE_SIZE, _tileParameter(request, "rows", TILE_ROWS))
+    cols = min(MAX_TILE_SIZE, _tileParameter(request, "cols", TILE_COLUMNS))
+
+    mentees = Mentee.objects.filter(is_deleted=False).order_by("pk")
+    mentors = Mentor.objects.all().order_by("pk")
+    total_rows = mentees.count()
+    total_cols = mentors.count()
+    mentees = list(mentees.select_related("user")[row:row+rows])
+    mentors = list(mentors.select_related("user")[col:col+cols])
+
+    response = HttpResponse(json.dumps({
+        "row": row,
+        "col": col,
+        "total_rows": total_rows,
+        "total_cols": total_cols,
+        # [id, response_id, name]
+        "mentees": [[mentee.pk, mentee.response_id, mentee.user.get_full_name()] for mentee in mentees],
+        "mentors": [[mentor.pk, mentor.response_id, mentor.user.get_full_name()] for mentor in mentors],
+        "scores": MatchScore.objects.tile(mentees, mentors),
+    }), content_type="application/json")
+    # make the browser check the ETag every time
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+@staff_member_required
+def breakdown(request):
+    """Return the score of a mentee and mentor pair, and how it breaks down, as
+    JSON. The match grid loads this when you hover over a score"""
+    try:
+        match_score = MatchScore.objects.get(mentee_id=request.GET.get("mentee_id"), mentor_id=request.GET.get("mentor_id"))
+    except (MatchScore.DoesNotExist, ValueError):
+        raise Http404
+
+    return HttpResponse(json.dumps({
+        "score": match_score.score,
+        "breakdown": match_score.parts(),
+    }), content_type="application/json")
+
 @staff_member_required
 def completions(request):
     completed = Match.objects.byMentor(married=True, completed=True)
@@ -77,40 +142,115 @@ def ments(request):
 def engage(request):
     mentor_id = request.POST.get("mentor_id")
     mentee_id = request.POST.get("mentee_id")
-    Match.objects.engage(mentor_id, mentee_id)
-    messages.success(request, 'Pair engaged')
+    if Match.objects.engage(mentor_id, mentee_id):
+        messages.success(request, 'Pair engaged')
+    else:
+        messages.error(request, "That mentor is full, or the pair is already matched")
+    return HttpResponseRedirect(reverse("manage-match"))
+
+@staff_member_required
+def accept(request):
+    """Engage all the pairs from a proposed assignment that were checked off"""
+    try:
+        actions = []
+        for pair in request.POST.getlist("pair"):
+            mentor_id, mentee_id = pair.split(":")
+            actions.append((mentor_id, mentee_id, "engage"))
+        results = Match.objects.apply(actions)
+    except ValueError:
+        messages.error(request, "The proposed pairs were not understood, so nothing was engaged")
+    else:
+        _summarize(request, results)
+    return HttpResponseRedirect(reverse("manage-match"))
+
+# what to say about the pairs bulk() applied, or couldn't
+APPLIED_MESSAGES = {
+    "engage": "%d pairs engaged",
+    "marry": "%d pairs married",
+    "complete": "%d pairs completed",
+    "breakup": "%d pairs broken up",
+    "divorce": "%d pairs divorced",
+}
+FAILED_MESSAGES = {
+    "engage": "%d pairs could not be engaged (the mentor is full, or the pair is already matched)",
+    "marry": "%d pairs could not be married (they aren't engaged)",
+    "complete": "%d pairs could not be completed (they aren't married)",
+    "breakup": "%d pairs could not be broken up (they aren't engaged)",
+    "divorce": "%d pairs could not be divorced (they aren't married)",
+}
+
+def _summarize(request, results):
+    """Add a message saying how many pairs each action was applied to (or
+    not)"""
+    for action in Match.objects.ACTIONS:
+        outcomes = [applied for mentor_id, mentee_id, a, applied in results if a == action]
+        if sum(outcomes):
+            messages.success(request, APPLIED_MESSAGES[action] % (sum(outcomes),))
+        if len(outcomes) - sum(outcomes):
+            messages.error(request, FAILED_MESSAGES[action] % (len(outcomes) - sum(outcomes),))
+
+@staff_member_required
+def bulk(request):
+    """Apply many actions at once. Each "pair" parameter is
+    action:mentor_id:mentee_id, where action is engage, marry, complete,
+    breakup or divorce. AJAX requests get a JSON list of what happened to each
+    pair; everyone else is sent back to the match page"""
+    try:
+        actions = []
+        for pair in request.POST.getlist("pair"):
+            action, mentor_id, mentee_id = pair.split(":")
+            actions.append((mentor_id, mentee_id, action))
+        results = Match.objects.apply(actions)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    if request.is_ajax():
+        return HttpResponse(json.dumps([
+            {"mentor_id": mentor_id, "mentee_id": mentee_id, "action": action, "applied": applied}
+            for mentor_id, mentee_id, action, applied in results
+        ]), content_type="application/json")
+
+    _summarize(request, results)
     return HttpResponseRedirect(reverse("manage-match"))
 
 @staff_member_required
 def breakup(request):
     mentor_id = request.POST.get("mentor_id")
     mentee_id = request.POST.get("mentee_id")
-    Match.objects.breakup(mentor_id, mentee_id)
-    messages.success(request, 'Pair broken up')
+    if Match.objects.breakup(mentor_id, mentee_id):
+        messages.success(request, 'Pair broken up')
+    else:
+        messages.error(request, "That pair isn't engaged")
     return HttpResponseRedirect(reverse("manage-match"))
 
 @staff_member_required
 def marry(request):
     mentor_id = request.POST.get("mentor_id")
     mentee_id = request.POST.get("mentee_id")
-    Match.objects.marry(mentor_id, mentee_id)
-    messages.success(request, 'Pair married')
+    if Match.objects.marry(mentor_id, mentee_id):
+        messages.success(request, 'Pair married')
+    else:
+        messages.error(request, "That pair isn't engaged")
     return HttpResponseRedirect(reverse("manage-match"))
 
 @staff_member_required
 def divorce(request):
     mentor_id = request.POST.get("mentor_id")
     mentee_id = request.POST.get("mentee_id")
-    Match.objects.divorce(mentor_id, mentee_id)
-    messages.success(request, 'Pair divorced')
+    if Match.objects.divorce(mentor_id, mentee_id):
+        messages.success(request, 'Pair divorced')
+    else:
+        messages.error(request, "That pair isn't married")
     return HttpResponseRedirect(reverse("manage-match"))
 
 @staff_member_required
 def complete(request):
     mentor_id = request.POST.get("mentor_id")
     mentee_id = request.POST.get("mentee_id")
-    Match.objects.complete(mentor_id, mentee_id)
-    messages.success(request, 'Pair completed')
+    if Match.objects.complete(mentor_id, mentee_id):
+        messages.success(request, 'Pair completed')
+    else:
+        messages.error(request, "That pair isn't married")
     return HttpResponseRedirect(reverse("manage-match"))
 
 @staff_member_required
@@ -113,6 +113,28 @@ AUTHENTICATION_BACKENDS = global_settings.AUTHENTICATION_BACKENDS + (
 
 ROOT_URLCONF = 'mentoring.urls'
 
+# the number of processes used to score the pairs in a tile of the match grid
+# that aren't stored yet. 1 means the scoring is done in the request's own
+# process
+MATCH_SCORING_PROCESSES = 1
+# store how each match score breaks down (field of study, gender, etc), so the
+# match grid can show it
+MATCH_SCORE_BREAKDOWN = True
+
+# the Settings model and the survey schemas are cached in each process, and a
+# token in this cache tells the processes when to reload them. So it has to be
+# a cache every process (like each mod_wsgi process) shares, not the default
+# in-memory one. The table is created by `./manage.py createcachetable
+# mentoring_cache`. Memcached works too, if python-memcached is installed:
+#     'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#     'LOCATION': '127.0.0.1:11211',
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'mentoring_cache',
+    }
+}
+
 # Python dotted path to the WSGI application used by Django's runserver.
 WSGI_APPLICATION = 'mentoring.wsgi.application'
 
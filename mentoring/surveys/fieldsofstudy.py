@@ -0,0 +1,162 @@
+# The fields of study taxonomy (the PSU colleges, schools and offices, and
+# the departments in each). The field of study questions are select multiple
+# questions, where each college is a heading choice, whose value is a JSON
+# list of the choice_ids of its departments (see NestedModelMultipleChoiceField)
+from .models import Choice
+
+# the questions that use the taxonomy
+FIELD_OF_STUDY_QUESTIONS = [17, 19, 49, 51]
+
+FIELDS_OF_STUDY = """Maseeh College of Engineering and Computer Science
+Civil and Environmental Engineering
+Computer Science
+Electrical and Computer Engineering
+Mechanical and Materials Engineering
+Engineering and Technology Management
+
+College of Liberal Arts and Sciences
+Anthropology
+Applied Linguistics
+Biology
+Black Studies
+Center for Science Education
+Chemistry
+Chicano and Latino Studies
+Communication
+Conflict Resolution
+Economics
+English
+Environmental Sciences and Management
+Geography
+Geology
+History
+International Studies
+Judaic Studies
+Mathematics
+Indigenous Nations Studies Program
+Philosophy
+Physics
+Psychology
+School of the Environment
+Sociology
+Speech and Hearing Sciences
+Women, Gender, Sexuality Studies
+World Languages and Literatures
+
+College of Urban and Public Affairs
+Institution for Portland Metro Studies & Pop Res Center
+School of Community Health
+Hatfield School of Government
+Public Administration
+Toulan School of Urban Studies & Planning
+
+School of Business Administration
+Accounting
+Advertising Management
+Finance
+Finance
+Human Resources Management
+Management & Leadership
+Marketing
+Real Estate
+Supply & Logistics Management
+
+School of Extended Studies
+Extended Campus
+Independent Study
+Professional Development Center
+Summer Session
+
+School of Fine and Performing Arts
+Art
+Architecture
+Music
+Theater Arts
+
+Graduate School of Education
+Curriculum & Instruction
+Educational Leadership & Policy
+Special Education
+Counselor Education
+
+School of Social Work
+Child & Family Studies
+PhD Program
+MSW Program
+Child Welfare Partnership Program
+Regional Research Institute
+
+University Library
+
+Office of Academic Affairs
+University Honors Program
+University Studies
+Center for Academic Excellence/Center for Online Learning
+Ronald E. McNair Program
+USARMY Gold
+
+Office of Enrollment Management and Student Affairs
+
+Office of the Dean of Student Life
+
+Office of Admissions, Registration, and Records
+
+Office of Finance & Administration
+
+Office of Human Resources
+
+Facilities and Property Management
+
+Campus Public Safety Office
+
+Office of General Counsel
+
+Office of Global Diversity and Inclusion
+
+Office of Graduate Studies
+
+Office of Institutional Research and Planning
+
+Office of International Affairs
+
+Office of Research and Strategic Partnerships
+
+Office of University Advancement
+
+Office of the President"""
+
+def taxonomy():
+    """Return a list of the fields of study. Each item is either the name of a
+    field of study, or a (heading, [fields of study]) tuple"""
+    choices = []
+    for block in FIELDS_OF_STUDY.split("\n\n"):
+        if "\n" in block:
+            subchoices = block.split("\n")
+            heading = subchoices.pop(0)
+            choices.append((heading, subchoices))
+        else:
+            choices.append(block)
+    return choices
+
+def addChoices(question):
+    """Replace the choices on the question with the fields of study"""
+    Choice.objects.filter(question=question).delete()
+    i = 0
+    for choice in taxonomy():
+        if isinstance(choice, tuple):
+            heading, subchoices = choice
+            parent = Choice(question=question, body=heading, value='[]', has_textbox=False, rank=i)
+            parent.save()
+            i += 1
+            subchoice_ids = []
+            for c in subchoices:
+                c = Choice(question=question, body=c, value=c, has_textbox=False, rank=i)
+                c.save()
+                subchoice_ids.append(c.pk)
+                i += 1
+            parent.value = "[%s]" % (",".join([str(x) for x in subchoice_ids]),)
+            parent.save()
+        else:
+            c = Choice(question=question, body=choice, value=choice, has_textbox=False, rank=i)
+            c.save()
+            i += 1
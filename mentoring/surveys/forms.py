@@ -1,21 +1,27 @@
-import json
 from django import forms
 from django.forms.widgets import RadioSelect
 from django.conf import settings as SETTINGS
-from django.core.mail import send_mail
 from django.contrib.auth.models import User
-from .models import Question, Choice, Response, ResponseQuestion
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils.encoding import force_text
+from .models import Survey, Question, Choice, Response, ResponseQuestion, ResponseDocument
 from .checkbox import CheckboxSelectMultiple
+from .signals import response_changed
+from mentoring.matches.models import Outbox
 
 class SurveyForm(forms.Form):
     def __init__(self, *args, **kwargs):
         self.survey = kwargs.pop("survey")
         super(SurveyForm, self).__init__(*args, **kwargs)
 
-        questions = list(Question.objects.filter(survey=self.survey))
+        # the questions and choices come from the compiled schema, so building
+        # the form doesn't query the database
+        schema = Survey.objects.schema(self.survey.pk)
         # add all the fields for each question
-        for q in questions:
-            item = self.questionToFormField(q)
+        for compiled in schema.questions:
+            q = compiled.question
+            item = self.questionToFormField(compiled)
             # associate the DB question with the form question so we can access
             # the DB question later
             item.question = q
@@ -25,29 +31,9 @@ class SurveyForm(forms.Form):
             # optional textfield associated with it, we need to add that
             # "subquestion" to the form
             if Question.couldHaveSubquestion(q.type):
-                choices = item.queryset.all()
-                for c in choices:
-                    if c.has_textbox:
-                        field = forms.CharField(required=False, min_length=0, max_length=255)
-                        self.fields['subquestion_%d' % c.pk] = field
-
-        # figure out which form item will start/close a new layout.
-        # This is helpful because in a template, we need to create the opening
-        # <table> and closing </table> tags when rendering a tabular layout 
-        state = 1
-        for i, q in enumerate(questions):
-            if state == 1:
-                # find the beginning of a non-normal question layout
-                if q.layout != Question.NORMAL:
-                    # mark the question as starting the layout
-                    q.start_layout = True
-                    state = 2
-            elif state == 2:
-                # find the end of the non-normal question layout 
-                if q.layout == Question.NORMAL:
-                    # mark the *previous* question to stop the non-normal layout
-                    questions[i-1].stop_layout = True
-                    state = 1
+                for choice_id in compiled.subquestions:
+                    field = forms.CharField(required=False, min_length=0, max_length=255)
+                    self.fields['subquestion_%d' % choice_id] = field
 
     def questionFields(self):
         """Return the list of question fields for the form"""
@@ -64,7 +50,7 @@ class SurveyForm(forms.Form):
                 # it is easily rendered in the template
                 if Question.couldHaveSubquestion(item.question.type):
                     choice_fields = []
-                    choices = list(self.fields[k].queryset)
+                    choices = self.fields[k].choice_objects
                     for field, choice in zip(item, choices):
                         if choice.has_textbox:
                             # tack on the extra textbox field for this choice
@@ -74,8 +60,9 @@ class SurveyForm(forms.Form):
 
                 yield item
 
-    def questionToFormField(self, question):
-        """Generate a form field for a question"""
+    def questionToFormField(self, compiled):
+        """Generate a form field for a CompiledQuestion (see SurveySchema)"""
+        question, choices = compiled.question, compiled.choices
         if question.type == Question.TEXTBOX:
             item = forms.CharField(
                 min_length=0, 
@@ -84,36 +71,33 @@ class SurveyForm(forms.Form):
                 required=question.required,
             ) 
         elif question.type == Question.CHECKBOX:
-            item = forms.ModelMultipleChoiceField(
+            item = CompiledMultipleChoiceField(
+                choices,
                 widget=CheckboxSelectMultiple, 
-                queryset=Choice.objects.filter(question=question),
                 label=question.body,
-                cache_choices=True,
                 required=question.required,
             )
         elif question.type == Question.SELECT_MULTIPLE:
             # special field type so <optgroup> tags are used
             item = NestedModelMultipleChoiceField(
+                compiled.tree,
                 widget=CheckboxSelectMultiple,
-                queryset=Choice.objects.filter(question=question),
                 label=question.body,
                 required=question.required,
             )
         elif question.type == Question.RADIO:
-            item = forms.ModelChoiceField(
+            item = CompiledChoiceField(
+                choices,
                 widget=RadioSelect,
-                queryset=Choice.objects.filter(question=question),
                 label=question.body,
                 empty_label=None,
-                cache_choices=True,
                 required=question.required,
             )
         elif question.type == Question.SELECT:
-            item = forms.ModelChoiceField(
-                queryset=Choice.objects.filter(question=question),
+            item = CompiledChoiceField(
+                choices,
                 label=question.body,
                 empty_label="",
-                cache_choices=True,
                 required=question.required,
             )
         elif question.type == Question.LIKERT:
@@ -182,18 +166,14 @@ class SurveyForm(forms.Form):
         return cleaned
 
     def _send_notification(self, user):
-        send_mail("GDI Mentoring Survey Notification", "This is just a notice to inform you that %s has taken a survey, which you may view at http://gdimentor.rc.pdx.edu/manage" % (user.username), 'django@pdx.edu', [SETTINGS.NOTIFICATION_EMAIL])
+        # queued, and sent by the sendoutbox command
+        Outbox.objects.enqueue("GDI Mentoring Survey Notification", "This is just a notice to inform you that %s has taken a survey, which you may view at http://gdimentor.rc.pdx.edu/manage" % (user.username), 'django@pdx.edu', [SETTINGS.NOTIFICATION_EMAIL])
 
-    def save(self, user):
+    def answers(self, response):
+        """Return the (unsaved) ResponseQuestion objects for the cleaned
+        answers, for the response"""
         cleaned = self.cleaned_data
-        response = Response()
-        response.user = user
-        response.survey = self.survey
-        response.save()
-
-        self._send_notification(user)
-
-        # create all the ResponseQuestion objects
+        answers = []
         for k, field in self.fields.items():
             # ignore non question fields
             if not k.startswith("question_"): continue
@@ -213,7 +193,7 @@ class SurveyForm(forms.Form):
                     # by the user. But to make this code more generic, we
                     # package that into a list, so we can use a for loop to
                     # create the QuestionResponse objects
-                    choices = [cleaned[k]]
+                    choices = [cleaned[k]] if cleaned[k] is not None else []
 
                 for choice in choices:
                     rq = ResponseQuestion()
@@ -225,7 +205,7 @@ class SurveyForm(forms.Form):
                         rq.value = cleaned[textbox_key]
                     else:
                         rq.value = choice.value 
-                    rq.save()
+                    answers.append(rq)
             else:
                 # if the field doesn't have a queryset attribute, just save the
                 # field's value. No foreign key needed
@@ -233,10 +213,95 @@ class SurveyForm(forms.Form):
                 rq.response = response
                 rq.question = field.question
                 rq.value = cleaned[k]
-                rq.save()
+                answers.append(rq)
+
+        return answers
+
+    def prefill(self, user):
+        """Fill the form in with the user's current answers to the survey, if
+        they have any"""
+        rows = ResponseQuestion.objects.filter(
+            response__user=user,
+            response__survey=self.survey,
+            response__is_latest=True
+        ).values_list("question_id", "choice_id", "value")
+        for question_id, choice_id, value in rows:
+            key = "question_%d" % (question_id,)
+            field = self.fields.get(key)
+            if field is None:
+                continue
+            if hasattr(field, "choice_lookup"):
+                if field.question.isMultiValued():
+                    self.initial.setdefault(key, []).append(choice_id)
+                else:
+                    self.initial[key] = choice_id
+                # the choice's textbox
+                if "subquestion_%d" % (choice_id,) in self.fields:
+                    self.initial["subquestion_%d" % (choice_id,)] = value
+            else:
+                self.initial[key] = value
 
+    @transaction.atomic
+    def save(self, user):
+        """Save the answers as the user's response to the survey. If they
+        already have one, it is edited, and only the answers that changed are
+        written. Sends response_changed, and sets changed_question_ids to the
+        ids of the questions whose answers changed"""
+        try:
+            response = Response.objects.select_for_update().get(user=user, survey=self.survey, is_latest=True)
+        except Response.DoesNotExist:
+            response = Response()
+            response.user = user
+            response.survey = self.survey
+            response.save()
+            # all the answers are written at once
+            answers = self.answers(response)
+            ResponseQuestion.objects.bulk_create(answers)
+            changed = frozenset(rq.question_id for rq in answers)
+        else:
+            changed = self._saveChanges(response)
+            if changed:
+                # bump updated_on
+                response.save()
+
+        if changed:
+            # the answer sheet, for reports
+            ResponseDocument.objects.compile(response)
+            # the notification is queued in this transaction, so it is only
+            # sent once the response is committed
+            self._send_notification(user)
+            response_changed.send(sender=Response, response=response, question_ids=changed)
+
+        self.changed_question_ids = changed
         return response
 
+    def _saveChanges(self, response):
+        """Compare the answers to the ones saved for the response, and only
+        insert, update or delete the rows that are different. Returns a
+        frozenset of the ids of the questions that changed"""
+        # a question's answers are keyed by choice (text answers have none)
+        existing = dict(
+            ((rq.question_id, rq.choice_id), rq)
+            for rq in ResponseQuestion.objects.filter(response=response)
+        )
+        changed = set()
+        inserts = []
+        for rq in self.answers(response):
+            old = existing.pop((rq.question_id, rq.choice_id), None)
+            if old is None:
+                inserts.append(rq)
+                changed.add(rq.question_id)
+            elif old.value != rq.value:
+                ResponseQuestion.objects.filter(pk=old.pk).update(value=rq.value)
+                changed.add(rq.question_id)
+
+        # whatever is left wasn't answered this time
+        if existing:
+            ResponseQuestion.objects.filter(pk__in=[rq.pk for rq in existing.values()]).delete()
+            changed.update(question_id for question_id, choice_id in existing)
+        ResponseQuestion.objects.bulk_create(inserts)
+        return frozenset(changed)
+
 class MenteeSurveyForm(SurveyForm):
     def clean(self):
         cleaned = super(MenteeSurveyForm, self).clean()
@@ -270,49 +335,60 @@ class MenteeSurveyForm(SurveyForm):
 
         return cleaned
 
-class NestedModelMultipleChoiceField(forms.ModelMultipleChoiceField):
-    """This field type takes the queryset, and builds a 2D list of choices
-    based on it. That allows the choices to be displayed in <optgroups> tags
-    """
-    def __init__(self, *args, **kwargs):
-        super(NestedModelMultipleChoiceField, self).__init__(*args, **kwargs)
-        self.choices = self.nestChoices(self.queryset)
-
-    def nestChoices(self, queryset):
-        choice_lookup = {}
-        qs = list(queryset)
-        # index all the choices by pk
-        for choice in qs:
-            choice_lookup[choice.pk] = choice
-
-        # recursively build up the list of choices
-        def buildChoices(choice, choices, used_choices):
-            # base case: we already handled this choice
-            if choice.pk in used_choices:
-                return
-            # keep track of the choices we have handled (see base case)
-            used_choices[choice.pk] = True
-
-            if not choice.value.startswith('['):
-                # this is just a simple choice, so add it to the list of choices
-                choices.append((choice.pk, choice.body))
-            else:
-                # this choice has subchoices, so we need to load those up
-                choice_ids = json.loads(choice.value)
-                subchoices = []
-                for choice_id in choice_ids:
-                    # recursively build up the subchoices
-                    buildChoices(choice_lookup[choice_id], subchoices, used_choices)
-                # now add all those subchoices to this choice
-                choices.append((choice.body, subchoices))
-
-        choices = []
-        used_choices = {}
-        for choice in qs:
-            buildChoices(choice, choices, used_choices)
-                
+class CompiledChoicesMixin(object):
+    """Makes a model choice field take its choices from a list of Choice
+    objects (from the compiled SurveySchema) instead of a queryset, so
+    rendering and cleaning it doesn't query the database"""
+    def __init__(self, choice_objects, *args, **kwargs):
+        self.choice_objects = choice_objects
+        self.choice_lookup = dict((force_text(choice.pk), choice) for choice in choice_objects)
+        super(CompiledChoicesMixin, self).__init__(Choice.objects.none(), *args, **kwargs)
+
+    def _get_choices(self):
+        # the choices were set by hand (see NestedModelMultipleChoiceField)
+        if hasattr(self, '_choices'):
+            return self._choices
+        choices = [(choice.pk, self.label_from_instance(choice)) for choice in self.choice_objects]
+        if self.empty_label is not None:
+            choices.insert(0, (u"", self.empty_label))
         return choices
 
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+    def lookup(self, value):
+        """Return the Choice object for a submitted value"""
+        try:
+            return self.choice_lookup[force_text(value)]
+        except KeyError:
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice', params={'value': value})
+
+class CompiledChoiceField(CompiledChoicesMixin, forms.ModelChoiceField):
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        return self.lookup(value)
+
+class CompiledMultipleChoiceField(CompiledChoicesMixin, forms.ModelMultipleChoiceField):
+    def clean(self, value):
+        if self.required and not value:
+            raise ValidationError(self.error_messages['required'], code='required')
+        elif not self.required and not value:
+            return []
+        if not isinstance(value, (list, tuple)):
+            raise ValidationError(self.error_messages['list'], code='list')
+        chosen = set(self.lookup(pk) for pk in value)
+        self.run_validators(value)
+        # in the same order as the choices
+        return [choice for choice in self.choice_objects if choice in chosen]
+
+class NestedModelMultipleChoiceField(CompiledMultipleChoiceField):
+    """This field type takes a ChoiceTree, and displays its nested choices in
+    <optgroup> tags. Only the leaves of the tree can be picked"""
+    def __init__(self, tree, *args, **kwargs):
+        self.tree = tree
+        super(NestedModelMultipleChoiceField, self).__init__(tree.leaves, *args, **kwargs)
+        self.choices = tree.nested
+
 class BlankWidget(forms.widgets.Widget):
     """Used as the wiget for HeadingFields, since nothing needs to be rendered"""
     def render(self, name, value, attrs=None):
@@ -1,87 +1,177 @@
 # Python 2.6 doesn't have OrderedDict in the collections module
 from ordereddict import OrderedDict 
+import json
+from collections import defaultdict, namedtuple
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
+from mentoring.utils import serverSideCursor, VersionToken
+
+# changes every time a survey, question or choice is saved or deleted (see
+# VersionToken). For the change to reach every process, CACHES has to be a
+# cache they share
+SCHEMA_VERSION = VersionToken("mentoring.surveys.schema.version")
+
+class ReportRow(object):
+    """A row of Response.report() or Survey.report(), with an attribute for
+    each column"""
+    def __init__(self, columns, values):
+        self.__dict__.update(zip(columns, values))
+
+# a question in a SurveySchema, with its choices (in order), the ids of the
+# choices that have a textbox (a "subquestion"), and for a select multiple
+# question, its ChoiceTree (None for every other type)
+CompiledQuestion = namedtuple("CompiledQuestion", "question choices subquestions tree")
+
+class ChoiceTree(object):
+    """The choices of a select multiple question, nested under their
+    headings. A heading is a choice whose value is a JSON list of the
+    choice_ids under it (see fieldsofstudy.py). The JSON is parsed once, when
+    the SurveySchema is built, so rendering, validating and grouping the
+    answers don't have to.
+
+    nested is the list of (choice_id, body) and (heading body, [nested
+    choices]) the form field renders as <optgroup>s, leaves is the tuple of
+    choices that can actually be picked (in order), and groups maps the
+    choice_id of each leaf to the heading it is under (leaves that aren't
+    under a heading aren't in it)"""
+    def __init__(self, choices):
+        by_pk = dict((choice.pk, choice) for choice in choices)
+        used = set()
+        leaves = []
+        self.groups = {}
+
+        # recursively build up the list of choices
+        def build(choice, nested, heading):
+            # we already handled this choice
+            if choice.pk in used:
+                return
+            used.add(choice.pk)
+
+            if not choice.value.startswith('['):
+                # this is just a simple choice
+                nested.append((choice.pk, choice.body))
+                leaves.append(choice)
+                if heading is not None:
+                    self.groups[choice.pk] = heading
+            else:
+                # this choice has subchoices, so we need to load those up
+                subchoices = []
+                for choice_id in json.loads(choice.value):
+                    if choice_id in by_pk:
+                        build(by_pk[choice_id], subchoices, choice)
+                nested.append((choice.body, subchoices))
+
+        self.nested = []
+        for choice in choices:
+            build(choice, self.nested, None)
+        self.leaves = tuple(leaves)
+
+class SurveySchema(object):
+    """Everything a SurveyForm needs to know about a survey's questions and
+    choices, loaded in two queries. It is shared by every request in the
+    process (see SurveyManager.schema()), so don't modify it"""
+    def __init__(self, survey_id):
+        questions = list(Question.objects.filter(survey_id=survey_id))
+        choices = defaultdict(list)
+        for choice in Choice.objects.filter(question__survey_id=survey_id):
+            choices[choice.question_id].append(choice)
+
+        # figure out which question will start/close a new layout.
+        # This is helpful because in a template, we need to create the opening
+        # <table> and closing </table> tags when rendering a tabular layout 
+        state = 1
+        for i, q in enumerate(questions):
+            if state == 1:
+                # find the beginning of a non-normal question layout
+                if q.layout != Question.NORMAL:
+                    # mark the question as starting the layout
+                    q.start_layout = True
+                    state = 2
+            elif state == 2:
+                # find the end of the non-normal question layout 
+                if q.layout == Question.NORMAL:
+                    # mark the *previous* question to stop the non-normal layout
+                    questions[i-1].stop_layout = True
+                    state = 1
+
+        self.questions = tuple(
+            CompiledQuestion(
+                q,
+                tuple(choices[q.pk]),
+                tuple(c.pk for c in choices[q.pk] if c.has_textbox),
+                ChoiceTree(choices[q.pk]) if q.type == Question.SELECT_MULTIPLE else None,
+            )
+            for q in questions
+        )
+
+class SurveyManager(models.Manager):
+    def schema(self, survey_id):
+        """Return the SurveySchema for the survey, from a cache in this
+        process. It is rebuilt after any survey, question or choice is saved
+        or deleted (see schemaChanged())"""
+        version = SCHEMA_VERSION.get()
+        cached = SurveyManager.cache
+        if cached.get("version", 0) != version:
+            cached = SurveyManager.cache = {"version": version}
+        if survey_id not in cached:
+            cached[survey_id] = SurveySchema(survey_id)
+        return cached[survey_id]
+
+SurveyManager.cache = {}
 
 class Survey(models.Model):
     survey_id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=255)
 
+    objects = SurveyManager()
+
     def report(self):
-        rows = Question.objects.raw("""
-             SELECT
+        """Generate each user's latest response to the survey, as an
+        OrderedDict of question_id -> ReportRow (see Response.report()), where
+        every row also has the name and username of the user, and when they
+        submitted it. The rows are read from the response documents as they
+        are needed, so the whole survey is never in memory at once"""
+        # documents can't be compiled while the rows are streaming
+        ResponseDocument.objects.compileMissing(self)
+
+        cursor = serverSideCursor()
+        cursor.execute("""
+            SELECT
                 response.response_id,
                 auth_user.username,
-                CONCAT(auth_user.first_name, ' ', auth_user.last_name) AS name,
+                auth_user.first_name,
+                auth_user.last_name,
                 response.created_on,
-                question.question_id,
-                question.type,
-                question.body,
-                question.hide_label,
-                question.layout,
-                response_question.value as cached_value,
-                IF(choice.body IS NULL OR choice.has_textbox, response_question.value, choice.body) AS choice_body,
-                choice.has_textbox
+                response_document.document
             FROM
-                question
-            LEFT JOIN
-                response_question
+                response
+            INNER JOIN
+                response_document
             ON
-                response_question.question_id = question.question_id
-            LEFT JOIN 
-                (
-                SELECT * FROM response INNER JOIN (SELECT MAX(response_id) as response_id FROM response WHERE survey_id = %s GROUP BY user_id) max_response_ids USING(response_id)
-                ) response
-            ON response_question.response_id = response.response_id
+                response_document.response_id = response.response_id
             LEFT JOIN 
                 auth_user 
             ON response.user_id = auth_user.id
-            LEFT JOIN
-                choice USING (choice_id)
             WHERE
-                question.survey_id = %s
+                response.survey_id = %s AND
+                response.is_latest = 1
             ORDER BY
-                response.response_id,
-                question.rank,
-                choice.rank
-        """, (self.pk, self.pk))
-
-        # we get all the responses in one big query. We need to normalize the
-        # data. We build up an OrderedDict of the responses, where the key is
-        # the response_id, and the value is an OrderedDict of questions, where
-        # the key is the question_id, and the row is the Question object. If
-        # the question is a multi-valued type, we tack on the choice_rows
-        # attribute, which is an array of answer choices that correspond to the
-        # question multi-valued type).
-        responses = OrderedDict() 
-        for row in rows:
-            # we did left joins, which means a null response_id is a possibility
-            if row.response_id is None:
-                continue
-
-            response = responses.setdefault(row.response_id, OrderedDict())
-
-            # The same question can be in multiple rows because checkbox
-            # and select_multiple questions have mulitple responsequestion rows
-            # (one for each choice). We only want to return one question object for
-            # each question, so take each choice on checkbox, and select_multiple
-            # questions, and stick them into a list attached to the question object
-
-            if row.question_id not in response:
-                response[row.question_id] = row
-
-                if Question.isMultiValuedType(row.type):
-                    # this is a checkbox or select multiple type, so it has
-                    # multiple responses. So start a list of them
-                    row.choice_rows = [row.choice_body]
-            else:
-                # we will only be in this statement if the question is a
-                # checkbox or select multiple. We need to add this choice_body
-                # to the existing question object
-                question = response[row.question_id]
-                question.choice_rows.append(row.choice_body)
-
-        return responses.values()
+                response.response_id
+        """, (self.pk,))
+
+        try:
+            for response_id, username, first_name, last_name, created_on, document in cursor:
+                response = OrderedDict()
+                for row in ResponseDocument.toRows(document):
+                    row.username = username
+                    row.name = (first_name or "") + " " + (last_name or "")
+                    row.created_on = created_on
+                    response[row.question_id] = row
+                yield response
+        finally:
+            cursor.close()
 
     class Meta:
         db_table = "survey"
@@ -164,14 +254,44 @@ class Choice(models.Model):
     def __unicode__(self):
         return u'%s' % (self.body)
 
+@receiver(post_save, sender=Survey)
+@receiver(post_delete, sender=Survey)
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+@receiver(post_save, sender=Choice)
+@receiver(post_delete, sender=Choice)
+def schemaChanged(sender, **kwargs):
+    """Make every process rebuild its survey schemas"""
+    SurveyManager.cache = {}
+    SCHEMA_VERSION.bump()
+
 class Response(models.Model):
     response_id = models.AutoField(primary_key=True)
     created_on = models.DateTimeField(auto_now_add=True)
+    # when the answers were last edited
+    updated_on = models.DateTimeField(auto_now=True, db_index=True)
+    # True for each user's latest response to a survey, and NULL for the ones
+    # it replaced, so the unique index only allows one latest response
+    is_latest = models.NullBooleanField(default=True)
 
     user = models.ForeignKey(User)
     survey = models.ForeignKey(Survey)
 
     def report(self):
+        """Return a list of ReportRows, one for each question on the survey
+        (in order), with the question's question_id, type, body, hide_label
+        and layout, and the answer's choice_body. Multi-valued questions also
+        have choice_rows, the body of each choice picked. They are read from
+        the response's document, which is compiled if it is missing"""
+        try:
+            document = ResponseDocument.objects.get(pk=self.pk)
+        except ResponseDocument.DoesNotExist:
+            document = ResponseDocument.objects.compile(self)
+        return ResponseDocument.toRows(document.document)
+
+    def buildReport(self):
+        """Build the list of rows for report() from the answers in
+        response_question. Each row is a dict"""
         rows = Question.objects.raw("""
             SELECT
                 question.question_id,
@@ -180,7 +300,7 @@ class Response(models.Model):
                 question.hide_label,
                 question.layout,
                 response_question.value as cached_value,
-                IF(choice.body IS NULL OR choice.has_textbox, response_question.value, choice.body) AS choice_body,
+                CASE WHEN choice.body IS NULL OR choice.has_textbox THEN response_question.value ELSE choice.body END AS choice_body,
                 choice.has_textbox
             FROM
                 question
@@ -208,27 +328,71 @@ class Response(models.Model):
         questions = OrderedDict()
         # for each row, check to see if it does not exists in the dict. If so,
         # add it to the dict. If it is a multivalued type (checkbox or
-        # select multiple), tack on a new choice_rows attribute that is
+        # select multiple), tack on a new choice_rows list that is
         # appended to in the else clause
         for row in rows:
             if row.question_id not in questions:
-                questions[row.question_id] = row
+                questions[row.question_id] = {
+                    "question_id": row.question_id,
+                    "type": row.type,
+                    "body": row.body,
+                    "hide_label": bool(row.hide_label),
+                    "layout": row.layout,
+                    "choice_body": row.choice_body,
+                }
 
                 if Question.isMultiValuedType(row.type):
                     # this is a checkbox or select multiple type, so it has
-                    # multiple responses. So start a list of them
-                    row.choice_rows = [row.choice_body]
+                    # multiple responses. So start a list of them (which is
+                    # empty if the question wasn't answered)
+                    questions[row.question_id]["choice_rows"] = [] if row.choice_body is None else [row.choice_body]
             else:
                 # we will only be in this statement if the question is a
                 # checkbox or select multiple. We need to add this choice_body
-                # to the existing question object
-                existing_row = questions[row.question_id]
-                existing_row.choice_rows.append(row.choice_body)
+                # to the existing question
+                questions[row.question_id]["choice_rows"].append(row.choice_body)
 
         return questions.values()
 
     class Meta:
         db_table = 'response'
+        # also the index for finding the latest responses to a survey
+        # (Survey.report)
+        unique_together = (("survey", "is_latest", "user"),)
+
+class ResponseDocumentManager(models.Manager):
+    def compile(self, response):
+        """Build the response's document, and save (or update) it"""
+        document = ResponseDocument(response_id=response.pk, document=json.dumps(response.buildReport()))
+        document.save()
+        return document
+
+    def compileMissing(self, survey):
+        """Compile the document of each latest response to the survey that
+        doesn't have one yet. Returns how many were compiled"""
+        responses = Response.objects.filter(survey=survey, is_latest=True).exclude(pk__in=self.values("pk"))
+        compiled = 0
+        for response in responses:
+            self.compile(response)
+            compiled += 1
+        return compiled
+
+class ResponseDocument(models.Model):
+    """A response's answer sheet (see Response.report()), as JSON, so it can be
+    read with one primary key lookup instead of being rebuilt from
+    response_question. It is compiled when the response is saved"""
+    response = models.OneToOneField(Response, primary_key=True, related_name="+")
+    document = models.TextField()
+
+    objects = ResponseDocumentManager()
+
+    @staticmethod
+    def toRows(document):
+        """Turn a JSON document into a list of ReportRows"""
+        return [ReportRow(row.keys(), row.values()) for row in json.loads(document)]
+
+    class Meta:
+        db_table = 'response_document'
 
 class ResponseQuestion(models.Model):
     response_question_id = models.AutoField(primary_key=True)
@@ -240,3 +404,33 @@ class ResponseQuestion(models.Model):
 
     class Meta:
         db_table = 'response_question'
+        # for loading a response's answers (Response.report)
+        index_together = (
+            ("response", "question"),
+        )
+
+# Superseded responses, and their answers, are moved to these tables by the
+# archiveresponses command, so the hot tables only hold current responses.
+# The columns (and ids) are the same as response and response_question
+
+class ArchivedResponse(models.Model):
+    response_id = models.IntegerField(primary_key=True)
+    created_on = models.DateTimeField()
+    archived_on = models.DateTimeField()
+
+    user = models.ForeignKey(User, related_name="+")
+    survey = models.ForeignKey(Survey, related_name="+")
+
+    class Meta:
+        db_table = 'response_archive'
+
+class ArchivedResponseQuestion(models.Model):
+    response_question_id = models.IntegerField(primary_key=True)
+    value = models.TextField()
+
+    response = models.ForeignKey(ArchivedResponse)
+    question = models.ForeignKey(Question, related_name="+")
+    choice = models.ForeignKey(Choice, null=True, default=None, blank=True, related_name="+")
+
+    class Meta:
+        db_table = 'response_question_archive'
@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+# sent by SurveyForm.save() after a response is saved (sender is Response).
+# question_ids is a frozenset of the ids of the questions whose answers were
+# added, changed or removed, so caches can forget only what is affected
+response_changed = Signal(providing_args=["response", "question_ids"])
@@ -5,7 +5,17 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import json
+from StringIO import StringIO
 from django.test import TestCase
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.contrib.auth.models import User
+from .models import Survey, Question, Choice, Response, ResponseQuestion, ResponseDocument
+from .forms import SurveyForm
+from .views import _reportLines
+from .signals import response_changed
 
 
 class SimpleTest(TestCase):
@@ -14,3 +24,124 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class SurveyFormTest(TestCase):
+    def setUp(self):
+        self.survey = Survey.objects.create(name="Mentor")
+        self.question = Question.objects.create(survey=self.survey, type=Question.RADIO, rank=0, layout=Question.NORMAL)
+        self.choices = [Choice.objects.create(question=self.question, body=value, value=value, rank=rank) for rank, value in enumerate(["yes", "no"])]
+        self.user = User.objects.create_user("mentor", "")
+
+    def answer(self, choice):
+        form = SurveyForm({"question_%d" % self.question.pk: choice.pk}, survey=self.survey)
+        self.assertTrue(form.is_valid())
+        response = form.save(user=self.user)
+        return response, form.changed_question_ids
+
+    def test_edit_response(self):
+        changed = []
+        receiver = lambda sender, question_ids, **kwargs: changed.append(question_ids)
+        response_changed.connect(receiver)
+        try:
+            first, question_ids = self.answer(self.choices[0])
+            self.assertEqual(question_ids, frozenset([self.question.pk]))
+            # the response is edited, not replaced
+            second, question_ids = self.answer(self.choices[1])
+            self.assertEqual(second.pk, first.pk)
+            self.assertEqual(question_ids, frozenset([self.question.pk]))
+            self.assertEqual(list(ResponseQuestion.objects.values_list("choice_id", flat=True)), [self.choices[1].pk])
+            # nothing changed, so nothing is written
+            with CaptureQueriesContext(connection) as queries:
+                third, question_ids = self.answer(self.choices[1])
+            self.assertEqual(question_ids, frozenset())
+            self.assertFalse([query for query in queries if "INSERT INTO" in query["sql"] or " SET " in query["sql"] or "DELETE FROM" in query["sql"]])
+        finally:
+            response_changed.disconnect(receiver)
+        self.assertEqual(changed, [frozenset([self.question.pk])] * 2)
+
+        # the form is filled in with the current answers
+        form = SurveyForm(survey=self.survey)
+        form.prefill(self.user)
+        self.assertEqual(form["question_%d" % self.question.pk].value(), self.choices[1].pk)
+
+    def test_schema_is_cached(self):
+        Survey.objects.schema(self.survey.pk)
+        # building, rendering and validating the form only reads the schema's
+        # version token (from the shared cache's table)
+        with self.assertNumQueries(1):
+            form = SurveyForm({"question_%d" % self.question.pk: self.choices[1].pk}, survey=self.survey)
+            list(form.questionFields())
+            unicode(form["question_%d" % self.question.pk])
+            self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data["question_%d" % self.question.pk], self.choices[1])
+
+        # a new choice is picked up right away
+        maybe = Choice.objects.create(question=self.question, body="maybe", value="maybe", rank=2)
+        form = SurveyForm({"question_%d" % self.question.pk: maybe.pk}, survey=self.survey)
+        self.assertTrue(form.is_valid())
+
+    def test_choice_tree(self):
+        question = Question.objects.create(survey=self.survey, type=Question.SELECT_MULTIPLE, rank=1, layout=Question.NORMAL)
+        college = Choice.objects.create(question=question, body="College", value="[]", rank=0)
+        leaves = [Choice.objects.create(question=question, body=value, value=value, rank=rank) for rank, value in enumerate(["Physics", "Music"], 1)]
+        college.value = "[%d]" % leaves[0].pk
+        college.save()
+
+        tree = Survey.objects.schema(self.survey.pk).questions[1].tree
+        self.assertEqual(tree.nested, [("College", [(leaves[0].pk, "Physics")]), (leaves[1].pk, "Music")])
+        self.assertEqual(tree.leaves, tuple(leaves))
+        self.assertEqual(tree.groups, {leaves[0].pk: college})
+
+        # the field uses the same tree, and only the leaves can be picked
+        key = "question_%d" % question.pk
+        with self.assertNumQueries(1):
+            form = SurveyForm({"question_%d" % self.question.pk: self.choices[0].pk, key: [leaves[0].pk]}, survey=self.survey)
+            self.assertTrue(form.fields[key].tree is tree)
+            self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data[key], [leaves[0]])
+        form = SurveyForm({"question_%d" % self.question.pk: self.choices[0].pk, key: [college.pk]}, survey=self.survey)
+        self.assertFalse(form.is_valid())
+
+    def test_answers_are_saved_at_once(self):
+        checkbox = Question.objects.create(survey=self.survey, type=Question.CHECKBOX, rank=1, layout=Question.NORMAL)
+        options = [Choice.objects.create(question=checkbox, body=value, value=value, rank=rank) for rank, value in enumerate("abcd")]
+        form = SurveyForm({
+            "question_%d" % self.question.pk: self.choices[0].pk,
+            "question_%d" % checkbox.pk: [choice.pk for choice in options],
+        }, survey=self.survey)
+        self.assertTrue(form.is_valid())
+        with CaptureQueriesContext(connection) as queries:
+            response = form.save(user=self.user)
+        inserts = [query for query in queries if "INSERT INTO" in query["sql"] and "response_question" in query["sql"]]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(ResponseQuestion.objects.filter(response=response).count(), 5)
+
+    def test_report_with_unanswered_questions(self):
+        Question.objects.create(survey=self.survey, type=Question.CHECKBOX, rank=1, layout=Question.NORMAL, body="Pets", required=False)
+        Question.objects.create(survey=self.survey, type=Question.RADIO, rank=2, layout=Question.NORMAL, body="Mentored before?", required=False)
+        response, question_ids = self.answer(self.choices[0])
+        self.assertEqual([row.__dict__.get("choice_rows") for row in response.report()], [None, [], None])
+
+        questions = list(Question.objects.filter(survey=self.survey).exclude(type=Question.HEADING))
+        lines = list(_reportLines(self.survey, questions))
+        # the questions that weren't answered get a placeholder
+        self.assertTrue(lines[1].rstrip().endswith("yes,!,!"))
+
+    def test_document(self):
+        response, question_ids = self.answer(self.choices[1])
+        # the answer sheet is read with one query
+        with self.assertNumQueries(1):
+            report = response.report()
+        self.assertEqual([(row.question_id, row.choice_body) for row in report], [(self.question.pk, "no")])
+
+        # the CSV report reads the same documents
+        self.user.first_name, self.user.last_name = "Ada", "Lovelace"
+        self.user.save()
+        rows = [row for sheet in self.survey.report() for row in sheet.values()]
+        self.assertEqual([(row.name, row.choice_body) for row in rows], [("Ada Lovelace", "no")])
+
+        # documents that are missing are backfilled
+        ResponseDocument.objects.all().delete()
+        call_command("compiledocuments", stdout=StringIO())
+        self.assertEqual(json.loads(ResponseDocument.objects.get(pk=response.pk).document), [report[0].__dict__])
@@ -1,13 +1,16 @@
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.views.decorators.gzip import gzip_page
 from .models import Survey, Question, Response
 from .forms import SurveyForm, MenteeSurveyForm
 from mentoring.matches.models import Mentor, Mentee, MENTOR_SURVEY_PK, MENTEE_SURVEY_PK
 from mentoring.matches.decorators import staff_member_required
-from mentoring.matches.models import Settings
-from mentoring.utils import UnicodeWriter
+from mentoring.matches.models import Settings, MatchScore
+from mentoring.matches.scoring import SCORED_QUESTIONS
+from mentoring.utils import UnicodeWriter, Echo
 
 @login_required
 def survey(request, survey_id):
@@ -19,31 +22,46 @@ def survey(request, survey_id):
             return HttpResponseRedirect(reverse("surveys-done"))
     else:
         form = SurveyForm(survey=survey)
+        form.prefill(request.user)
 
     return render(request, 'surveys/survey.html', {
         'form': form,
         'Question': Question,
     })
 
+def _saveParticipant(form, model, user):
+    """Save the survey form, and create or update the user's Mentor or Mentee
+    (model) to point at the response, all in one transaction. Returns the
+    Mentor or Mentee, and whether its scores could have changed"""
+    with transaction.atomic():
+        response = form.save(user=user)
+        try:
+            participant = model.objects.select_for_update().get(user=user)
+        except model.DoesNotExist:
+            participant = model(user=user)
+
+        # the features used for scoring are compiled when the response changes
+        # (see responseChanged()), so it isn't done when the matches are scored
+        rescore = bool(form.changed_question_ids & SCORED_QUESTIONS)
+        if participant.pk is None or participant.response_id != response.pk:
+            participant.response = response
+            participant.save()
+            rescore = True
+    return participant, rescore
+
 @login_required
 def mentee(request):
     survey = get_object_or_404(Survey, pk=MENTEE_SURVEY_PK)
     if request.POST:
         form = MenteeSurveyForm(request.POST, survey=survey)
         if form.is_valid():
-            response = form.save(user=request.user)
-            # create the mentee object, or update it
-            try:
-                mentee = Mentee.objects.get(user=request.user)
-            except Mentee.DoesNotExist as e:
-                mentee = Mentee()
-                mentee.user = request.user
-
-            mentee.response = response
-            mentee.save()
+            mentee, rescore = _saveParticipant(form, Mentee, request.user)
+            if rescore:
+                MatchScore.objects.refreshMentee(mentee.pk)
             return HttpResponseRedirect(reverse("surveys-done"))
     else:
         form = MenteeSurveyForm(survey=survey)
+        form.prefill(request.user)
 
     return render(request, 'surveys/mentee.html', {
         'form': form,
@@ -56,21 +74,14 @@ def mentor(request):
     if request.POST:
         form = SurveyForm(request.POST, survey=survey)
         if form.is_valid():
-            response = form.save(user=request.user)
-
-            # create the mentor object, or update it
-            try:
-                mentor = Mentor.objects.get(user=request.user)
-            except Mentor.DoesNotExist as e:
-                mentor = Mentor()
-                mentor.user = request.user
-
-            mentor.response = response
-            mentor.save()
+            mentor, rescore = _saveParticipant(form, Mentor, request.user)
+            if rescore:
+                MatchScore.objects.refreshMentor(mentor.pk)
 
             return HttpResponseRedirect(reverse("surveys-done"))
     else:
         form = SurveyForm(survey=survey)
+        form.prefill(request.user)
 
     return render(request, 'surveys/survey.html', {
         'form': form,
@@ -79,7 +90,7 @@ def mentor(request):
 
 @login_required
 def done(request):
-    message = Settings.objects.default().end_of_survey_message
+    message = Settings.objects.cached().end_of_survey_message
     return render(request, "surveys/done.html", {
         'message': message,
     })
@@ -95,37 +106,41 @@ def response(request, response_id):
     })
 
 @staff_member_required
+@gzip_page
 def report(request, survey_id):
+    """Stream the survey's responses as CSV, one response at a time (and
+    gzipped, if the browser accepts it)"""
     survey = get_object_or_404(Survey, pk=survey_id)
-    responses = list(survey.report())
     questions = list(Question.objects.filter(survey=survey).exclude(type=Question.HEADING))
 
-    http_response = HttpResponse()
-    http_response = HttpResponse(content_type='text/csv')
+    http_response = StreamingHttpResponse(_reportLines(survey, questions), content_type='text/csv')
     http_response['Content-Disposition'] = 'attachment; filename="%s.csv"' % (survey.name)
+    return http_response
 
-    writer = UnicodeWriter(http_response)
+def _reportLines(survey, questions):
+    """Generate the lines of the survey's CSV report"""
+    writer = UnicodeWriter(Echo())
     header = ["name", "username", "submitted on"] + [question.body for question in questions]
-    writer.writerow(header)
+    yield writer.writerow(header)
 
-    for response in responses:
-        csv_row = []
-        for i, question in enumerate(questions):
+    for response in survey.report():
+        # every row has the response's name, username and date
+        first = next(iter(response.values()))
+        csv_row = [first.name, first.username, first.created_on.strftime("%Y-%m-%d %H:%M:%S")]
+        for question in questions:
             row = response.get(question.pk, None)
-            if i == 0:
-                csv_row.append(row.name)
-                csv_row.append(row.username)
-                csv_row.append(row.created_on.strftime("%Y-%m-%d %H:%M:%S"))
-
             if row is None:
                 csv_row.append("!")
                 continue
 
+            # a question that wasn't answered is in the document with no
+            # choice_body (older documents have a None in its choice_rows)
             if hasattr(row, 'choice_rows'):
-                csv_row.append(",".join(row.choice_rows))
+                choices = [choice for choice in row.choice_rows if choice is not None]
+                csv_row.append(",".join(choices) if choices else "!")
+            elif row.choice_body is None:
+                csv_row.append("!")
             else:
                 csv_row.append(row.choice_body)
-        writer.writerow(csv_row)
-
-    return http_response
+        yield writer.writerow(csv_row)
 
@@ -22,9 +22,13 @@ urlpatterns = patterns('',
     url(r'^matches/marry/?$', matches.views.marry, name='matches-marry'),
     url(r'^matches/divorce/?$', matches.views.divorce, name='matches-divorce'),
     url(r'^matches/engage/?$', matches.views.engage, name='matches-engage'),
+    url(r'^matches/accept/?$', matches.views.accept, name='matches-accept'),
+    url(r'^matches/bulk/?$', matches.views.bulk, name='matches-bulk'),
     url(r'^matches/breakup/?$', matches.views.breakup, name='matches-breakup'),
     url(r'^matches/complete/?$', matches.views.complete, name='matches-complete'),
     url(r'^matches/report/?$', matches.views.report, name='matches-report'),
+    url(r'^matches/grid/?$', matches.views.grid, name='matches-grid'),
+    url(r'^matches/breakdown/?$', matches.views.breakdown, name='matches-breakdown'),
     # mentors and mentee administration
     url(r'^(mentors)/delete/?$', matches.views.remove, name='mentors-delete'),
     url(r'^(mentees)/delete/?$', matches.views.remove, name='mentees-delete'),
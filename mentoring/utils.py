@@ -1,4 +1,69 @@
 import csv, codecs, cStringIO
+import threading
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started, request_finished
+from django.db import connection
+from django.db.backends import util
+
+class VersionToken(object):
+    """A token in Django's cache that changes every time something each
+    process caches for itself (like the Settings) has to be rebuilt. The
+    cache is shared by every process, so reading the token can cost a query.
+    During a request, it is only read the first time it is needed"""
+    def __init__(self, key):
+        self.key = key
+        # each thread handles its own requests
+        self.local = threading.local()
+        request_started.connect(self.requestStarted, weak=False)
+        request_finished.connect(self.requestFinished, weak=False)
+
+    def get(self):
+        local = self.local
+        if not getattr(local, "fresh", False):
+            local.value = cache.get(self.key)
+            # outside of a request, it is read every time
+            local.fresh = getattr(local, "in_request", False)
+        return local.value
+
+    def bump(self):
+        """Change the token, so every process rebuilds what it cached"""
+        self.local.value = uuid.uuid4().hex
+        cache.set(self.key, self.local.value, None)
+
+    def requestStarted(self, **kwargs):
+        self.local.in_request = True
+        self.local.fresh = False
+
+    def requestFinished(self, **kwargs):
+        self.local.in_request = False
+        self.local.fresh = False
+
+def serverSideCursor():
+    """Return a database cursor that fetches rows from the server as they are
+    read, instead of loading the whole result into memory first (MySQL's
+    SSCursor). Nothing else can use the connection until every row is read.
+    On other databases, this is a normal cursor"""
+    if connection.vendor != "mysql":
+        return connection.cursor()
+
+    from MySQLdb.cursors import SSCursor
+    from django.db.backends.mysql.base import CursorWrapper
+    connection.ensure_connection()
+    cursor = CursorWrapper(connection.connection.cursor(SSCursor))
+    # wrap it like connection.cursor() does, so the queries are logged when
+    # DEBUG is on
+    if connection.use_debug_cursor or (connection.use_debug_cursor is None and settings.DEBUG):
+        return connection.make_debug_cursor(cursor)
+    return util.CursorWrapper(cursor, connection)
+
+class Echo(object):
+    """A file-like object whose write() just returns what it was given, so a
+    UnicodeWriter can produce the lines of a StreamingHttpResponse"""
+    def write(self, value):
+        return value
+
 class UnicodeWriter:
     """
     A CSV writer which will write rows to CSV file "f",
@@ -19,10 +84,10 @@ class UnicodeWriter:
         data = data.decode("utf-8")
         # ... and reencode it into the target encoding
         data = self.encoder.encode(data)
-        # write to the target stream
-        self.stream.write(data)
         # empty queue
         self.queue.truncate(0)
+        # write to the target stream
+        return self.stream.write(data)
 
     def writerows(self, rows):
         for row in rows:
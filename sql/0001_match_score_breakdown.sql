@@ -0,0 +1,2 @@
+-- Store the breakdown of each match score (see MatchScore.breakdown)
+ALTER TABLE `match_score` ADD COLUMN `breakdown` bigint NULL;
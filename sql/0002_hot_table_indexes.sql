@@ -0,0 +1,7 @@
+-- Composite indexes for the raw queries in the matches and surveys models
+-- (see the index_together in their Meta classes). The names are the ones
+-- syncdb gives them
+CREATE INDEX `match_1508a7ad` ON `match` (`mentor_id`, `is_deleted`, `completed_on`);
+CREATE INDEX `match_61faa41b` ON `match` (`mentee_id`, `is_deleted`);
+CREATE INDEX `response_0232dfbc` ON `response` (`survey_id`, `user_id`, `response_id`);
+CREATE INDEX `response_question_4ee76a49` ON `response_question` (`response_id`, `question_id`);
@@ -0,0 +1,9 @@
+-- Only one active (not completed) match for each mentor and mentee. Completed
+-- matches have is_active = NULL, which the unique index ignores
+ALTER TABLE `match` ADD COLUMN `is_active` bool NULL;
+UPDATE `match` SET `is_active` = 1 WHERE `completed_on` IS NULL;
+-- this fails if a pair already has two active matches. Find them with
+--   SELECT mentor_id, mentee_id FROM `match` WHERE is_active = 1
+--   GROUP BY mentor_id, mentee_id HAVING COUNT(*) > 1;
+-- and delete the extras first
+ALTER TABLE `match` ADD UNIQUE `mentor_id` (`mentor_id`, `mentee_id`, `is_active`);
@@ -0,0 +1,10 @@
+-- Flag each user's latest response to each survey, so Survey.report doesn't
+-- have to work it out with MAX(response_id) ... GROUP BY user_id. The
+-- responses it replaced have is_latest = NULL, which the unique index ignores
+ALTER TABLE `response` ADD COLUMN `is_latest` bool NULL;
+UPDATE `response` INNER JOIN (
+    SELECT MAX(response_id) AS response_id FROM `response` GROUP BY survey_id, user_id
+) latest USING(response_id) SET `response`.`is_latest` = 1;
+ALTER TABLE `response` ADD UNIQUE `survey_id` (`survey_id`, `is_latest`, `user_id`);
+-- this replaces the index for the MAX(response_id) subquery
+DROP INDEX `response_0232dfbc` ON `response`;
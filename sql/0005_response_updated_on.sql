@@ -0,0 +1,12 @@
+-- When each response's answers were last edited (responses are edited in
+-- place now, instead of being replaced). The column starts out nullable, so
+-- the existing rows never hold a zero date (which strict mode rejects)
+ALTER TABLE `response` ADD COLUMN `updated_on` datetime NULL;
+UPDATE `response` SET `updated_on` = `created_on`;
+ALTER TABLE `response` MODIFY `updated_on` datetime NOT NULL;
+-- the name is the one syncdb gives it
+CREATE INDEX `response_9f7ba574` ON `response` (`updated_on`);
+-- if you ran an earlier version of this script, the index is named
+-- response_c67f5cc7 instead. Rename it with
+--   DROP INDEX `response_c67f5cc7` ON `response`;
+--   CREATE INDEX `response_9f7ba574` ON `response` (`updated_on`);